@@ -0,0 +1,196 @@
+"""
+On-disk cache of parsed IDC models.
+
+Reading a distortion model from an IDCTAB requires opening and parsing the
+FITS table. When the cache is enabled, the result of
+`stwcs.distortion.mutil.readIDCtab` (cx, cy, refpix with the TDD skew
+coefficients, and the order) is stored in a small ``.npz`` file. Any later
+request for the same model, from any process, is served from that file.
+
+Entries are keyed by the identity of the reference files, the chip, the
+direction, the filters and, when an OFFTAB is used, the date. The identity
+of a reference file is either its size and mtime (default) or the SHA1
+checksum of its content, so an entry is not used after the reference file
+changes.
+
+The cache is disabled by default. It is enabled by setting the
+``STWCS_MODEL_CACHE`` environment variable to a directory (and optionally
+``STWCS_MODEL_CACHE_VALIDATE`` to 'checksum') or by calling
+`set_cache_dir`.
+
+Examples
+--------
+>>> from stwcs.distortion import modelcache
+>>> modelcache.set_cache_dir('/tmp/stwcs_models', validate='checksum')
+
+"""
+from __future__ import absolute_import, division, print_function # confidence high
+
+import os
+import json
+import hashlib
+import tempfile
+
+import numpy as np
+from stsci.tools import fileutil
+
+import logging
+logger = logging.getLogger('stwcs.distortion.modelcache')
+
+__all__ = ['set_cache_dir', 'get_cache_dir', 'read_model', 'file_signature']
+
+# Increase when the format of the cache files changes
+_FORMAT_VERSION = 1
+
+_cache_dir = os.environ.get('STWCS_MODEL_CACHE') or None
+_validate = os.environ.get('STWCS_MODEL_CACHE_VALIDATE', 'mtime')
+
+# checksums already computed, keyed by (path, size, mtime)
+_checksums = {}
+
+
+def set_cache_dir(path, validate='mtime'):
+    """
+    Enable the model cache.
+
+    Parameters
+    ----------
+    path : str or None
+        Directory where the models are stored, created if necessary.
+        None disables the cache.
+    validate : str
+        How a reference file is identified: 'mtime' (size and modification
+        time) or 'checksum' (SHA1 of the file content).
+    """
+    global _cache_dir, _validate
+    if validate not in ['mtime', 'checksum']:
+        raise ValueError("validate must be 'mtime' or 'checksum'")
+    if path is not None and not os.path.isdir(path):
+        os.makedirs(path)
+    _cache_dir = path
+    _validate = validate
+
+
+def get_cache_dir():
+    """
+    Return the cache directory or None if the cache is disabled.
+    """
+    return _cache_dir
+
+
+def file_signature(fname, validate=None):
+    """
+    Return a string identifying the content of a reference file.
+    """
+    if validate is None:
+        validate = _validate
+    fname = os.path.abspath(fileutil.osfn(fname))
+    st = os.stat(fname)
+    if validate == 'checksum':
+        key = (fname, st.st_size, st.st_mtime)
+        if key not in _checksums:
+            sha = hashlib.sha1()
+            with open(fname, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    sha.update(block)
+            _checksums[key] = sha.hexdigest()
+        return _checksums[key]
+    return '%s:%d:%r' % (fname, st.st_size, st.st_mtime)
+
+
+def _model_key(tabname, chip, direction, filter1, filter2, date, offtab):
+    key = [_FORMAT_VERSION, file_signature(tabname), str(chip),
+           str(direction).strip().lower(), str(filter1), str(filter2)]
+    if offtab:
+        # the date is used only to interpolate the OFFTAB
+        key.extend([file_signature(offtab), str(date)])
+    return hashlib.sha1(json.dumps(key).encode('utf-8')).hexdigest()
+
+
+def _to_builtin(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def _save(path, fx, fy, refpix, order):
+    arrays = {'cx': fx, 'cy': fy, 'order': np.array(order)}
+    meta = {}
+    skew = None
+    for k, v in refpix.items():
+        if k == 'skew_coeffs':
+            continue
+        meta[k] = _to_builtin(v)
+    if refpix.get('skew_coeffs') is not None:
+        skew = {}
+        for k, v in refpix['skew_coeffs'].items():
+            if isinstance(v, np.ndarray):
+                arrays['skew_' + k] = v
+            else:
+                skew[k] = _to_builtin(v)
+    arrays['meta'] = np.array(json.dumps({'refpix': meta, 'skew': skew}))
+
+    # Write to a temporary file and rename it so that other processes
+    # never see a partially written file.
+    fd, tmpname = tempfile.mkstemp(suffix='.npz', dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, **arrays)
+        os.rename(tmpname, path)
+    except (IOError, OSError):
+        if os.path.exists(tmpname):
+            os.remove(tmpname)
+        raise
+
+
+def _load(path):
+    with np.load(path) as npz:
+        meta = json.loads(str(npz['meta']))
+        refpix = meta['refpix']
+        skew = meta['skew']
+        if skew is not None:
+            for k in npz.files:
+                if k.startswith('skew_'):
+                    skew[k[5:]] = npz[k]
+        refpix['skew_coeffs'] = skew
+        return npz['cx'], npz['cy'], refpix, int(npz['order'])
+
+
+def read_model(reader, tabname, chip=1, date=None, direction='forward',
+               filter1=None, filter2=None, offtab=None):
+    """
+    Return a model from the cache or read it with reader and store it.
+
+    Parameters
+    ----------
+    reader : callable
+        Function with the signature of `~stwcs.distortion.mutil.readIDCtab`
+        used when the model is not in the cache.
+
+    The other parameters are passed to reader.
+    """
+    kwargs = dict(chip=chip, date=date, direction=direction, filter1=filter1,
+                  filter2=filter2, offtab=offtab)
+    if _cache_dir is None or tabname is None:
+        return reader(tabname, **kwargs)
+    try:
+        key = _model_key(tabname, chip, direction, filter1, filter2, date,
+                         offtab)
+    except OSError:
+        # a missing reference file is reported by the reader
+        return reader(tabname, **kwargs)
+
+    path = os.path.join(_cache_dir, key + '.npz')
+    if os.path.exists(path):
+        try:
+            return _load(path)
+        except Exception:
+            logger.warning("Could not read cached model %s, rereading %s",
+                           path, tabname)
+
+    fx, fy, refpix, order = reader(tabname, **kwargs)
+    try:
+        _save(path, fx, fy, refpix, order)
+    except (IOError, OSError):
+        logger.warning("Could not write model cache file %s", path)
+    return fx, fy, refpix, order
@@ -225,11 +225,7 @@ class GeometryModel:
 
         dxy = _p - (self.refpix['XREF'],self.refpix['YREF'])
         # Apply coefficients from distortion model here...
-        c = _p * 0.
-        for i in range(order+1):
-            for j in range(i+1):
-                c[:,0] = c[:,0] + _cx[i][j] * pow(dxy[:,0],j) * pow(dxy[:,1],(i-j))
-                c[:,1] = c[:,1] + _cy[i][j] * pow(dxy[:,0],j) * pow(dxy[:,1],(i-j))
+        c = mutil.apply_poly2d(_cx, _cy, dxy, order)
         xc = c[:,0]
         yc = c[:,1]
 
@@ -245,6 +241,9 @@ class GeometryModel:
         return xc,yc
 
     def setPScaleCoeffs(self,pscale):
+        # the coefficients may be shared with a cloned WCS (HSTWCS.clone)
+        self.cx = self.cx.copy()
+        self.cy = self.cy.copy()
         self.cx[1,1] = pscale
         self.cy[1,0] = pscale
 
@@ -4,6 +4,9 @@ from stsci.tools import fileutil
 import numpy as np
 import calendar
 
+from . import refcache
+from . import modelcache
+
 # Set up IRAF-compatible Boolean values
 yes = True
 no = False
@@ -28,7 +31,15 @@ def readIDCtab (tabname, chip=1, date=None, direction='forward',
         If tabname == None, then return a default, undistorted solution.
         If offtab is specified, dateobs also needs to be given.
 
+        If the on-disk model cache is enabled (see `modelcache`), the
+        model is read from the cache when available.
     """
+    return modelcache.read_model(_readIDCtab, tabname, chip=chip, date=date,
+                                 direction=direction, filter1=filter1,
+                                 filter2=filter2, offtab=offtab)
+
+def _readIDCtab (tabname, chip=1, date=None, direction='forward',
+                filter1=None,filter2=None, offtab=None):
 
  # Return a default geometry model if no IDCTAB filename
     # is given.  This model will not distort the data in any way.
@@ -48,9 +59,11 @@ def readIDCtab (tabname, chip=1, date=None, direction='forward',
     # expanded to '/data/cdbs7/jref/mc41442gj_idc.fits' before
     # being used here.
     # Open up IDC table now...
+    # The table is indexed once and the index is kept in the reference
+    # file cache, so the lookups below do not read the table again.
     try:
-        ftab = fileutil.openImage(tabname)
-    except:
+        idcindex = refcache.get_reference(tabname, loader=IDCTabIndex)
+    except IOError:
         err_str =  "------------------------------------------------------------------------ \n"
         err_str += "WARNING: the IDCTAB geometric distortion file specified in the image     \n"
         err_str += "header was not found on disk. Please verify that your environment        \n"
@@ -65,16 +78,9 @@ def readIDCtab (tabname, chip=1, date=None, direction='forward',
 
     #First thing we need, is to read in the coefficients from the IDC
     # table and populate the Fx and Fy matrices.
-
-    if 'DETECTOR' in ftab['PRIMARY'].header:
-        detector = ftab['PRIMARY'].header['DETECTOR']
-    else:
-        if 'CAMERA' in ftab['PRIMARY'].header:
-            detector = str(ftab['PRIMARY'].header['CAMERA'])
-        else:
-            detector = 1
+    detector = idcindex.detector
     # First, read in TDD coeffs if present
-    phdr = ftab['PRIMARY'].header
+    phdr = idcindex.phdr
     instrument = phdr['INSTRUME']
     if instrument == 'ACS' and detector == 'WFC':
         skew_coeffs = read_tdd_coeffs(phdr, chip=chip)
@@ -89,75 +95,10 @@ def readIDCtab (tabname, chip=1, date=None, direction='forward',
         if filter2 == 'CLEAR':
             filter2 = 'N/A'
 
-    # Read FITS header to determine order of fit, i.e. k
-    norder = ftab['PRIMARY'].header['NORDER']
-    if norder < 3:
-        order = 3
-    else:
-        order = norder
-
-    fx = np.zeros(shape=(order+1,order+1),dtype=np.float64)
-    fy = np.zeros(shape=(order+1,order+1),dtype=np.float64)
+    order = idcindex.order
 
     #Determine row from which to get the coefficients.
-    # How many rows do we have in the table...
-    fshape = ftab[1].data.shape
-    colnames = ftab[1].data.names
-    row = -1
-
-    # Loop over all the rows looking for the one which corresponds
-    # to the value of CCDCHIP we are working on...
-    for i in range(fshape[0]):
-
-        try:
-            # Match FILTER combo to appropriate row,
-            #if there is a filter column in the IDCTAB...
-            if 'FILTER1' in colnames and 'FILTER2' in colnames:
-
-                filt1 = ftab[1].data.field('FILTER1')[i]
-                if filt1.find('CLEAR') > -1: filt1 = filt1[:5]
-
-                filt2 = ftab[1].data.field('FILTER2')[i]
-                if filt2.find('CLEAR') > -1: filt2 = filt2[:5]
-            else:
-                if 'OPT_ELEM' in colnames:
-                    filt1 = ftab[1].data.field('OPT_ELEM')
-                    if filt1.find('CLEAR') > -1: filt1 = filt1[:5]
-                else:
-                    filt1 = filter1
-
-                if 'FILTER' in colnames:
-                    _filt = ftab[1].data.field('FILTER')[i]
-                    if _filt.find('CLEAR') > -1: _filt = _filt[:5]
-                    if 'OPT_ELEM' in colnames:
-                        filt2 = _filt
-                    else:
-                        filt1 = _filt
-                        filt2 = 'CLEAR'
-                else:
-                    filt2 = filter2
-        except:
-            # Otherwise assume all rows apply and compare to input filters...
-            filt1 = filter1
-            filt2 = filter2
-
-        if 'DETCHIP' in colnames:
-            detchip = ftab[1].data.field('DETCHIP')[i]
-            if not str(detchip).isdigit():
-                detchip = 1
-        else:
-            detchip = 1
-
-        if 'DIRECTION' in colnames:
-            direct = ftab[1].data.field('DIRECTION')[i].lower().strip()
-        else:
-            direct = 'forward'
-
-        if filt1 == filter1.strip() and filt2 == filter2.strip():
-            if direct == direction.strip():
-                if int(detchip) == int(chip) or int(detchip) == -999:
-                    row = i
-                    break
+    row = idcindex.find_row(filter1, filter2, chip, direction)
 
     joinstr = ','
     if 'CLEAR' in filter1:
@@ -173,20 +114,20 @@ def readIDCtab (tabname, chip=1, date=None, direction='forward',
     filtstr = (joinstr.join([f1str,f2str])).strip()
     if row < 0:
         err_str = '\nProblem finding row in IDCTAB! Could not find row matching:\n'
-        err_str += '        CHIP: '+str(detchip)+'\n'
+        err_str += '        CHIP: '+str(chip)+'\n'
         err_str += '     FILTERS: '+filtstr+'\n'
-        ftab.close()
-        del ftab
         raise LookupError(err_str)
     else:
+        detchip = idcindex.detchip[row]
         print('- IDCTAB: Distortion model from row',str(row+1),'for chip',detchip,':',filtstr)
 
     # Read in V2REF and V3REF: this can either come from current table,
     # or from an OFFTAB if time-dependent (i.e., for WFPC2)
     theta = None
-    if 'V2REF' in colnames:
-        v2ref = ftab[1].data.field('V2REF')[row]
-        v3ref = ftab[1].data.field('V3REF')[row]
+    columns = idcindex.columns
+    if 'V2REF' in columns:
+        v2ref = columns['V2REF'][row]
+        v3ref = columns['V3REF'][row]
     else:
         # Read V2REF/V3REF from offset table (OFFTAB)
         if offtab:
@@ -196,17 +137,17 @@ def readIDCtab (tabname, chip=1, date=None, direction='forward',
             v3ref = 0.0
 
     if theta == None:
-        if 'THETA' in colnames:
-            theta = ftab[1].data.field('THETA')[row]
+        if 'THETA' in columns:
+            theta = columns['THETA'][row]
         else:
             theta = 0.0
 
     refpix = {}
-    refpix['XREF'] = ftab[1].data.field('XREF')[row]
-    refpix['YREF'] = ftab[1].data.field('YREF')[row]
-    refpix['XSIZE'] = ftab[1].data.field('XSIZE')[row]
-    refpix['YSIZE'] = ftab[1].data.field('YSIZE')[row]
-    refpix['PSCALE'] = round(ftab[1].data.field('SCALE')[row],8)
+    refpix['XREF'] = columns['XREF'][row]
+    refpix['YREF'] = columns['YREF'][row]
+    refpix['XSIZE'] = columns['XSIZE'][row]
+    refpix['YSIZE'] = columns['YSIZE'][row]
+    refpix['PSCALE'] = round(columns['SCALE'][row],8)
     refpix['V2REF'] = v2ref
     refpix['V3REF'] = v3ref
     refpix['THETA'] = theta
@@ -215,27 +156,10 @@ def readIDCtab (tabname, chip=1, date=None, direction='forward',
     refpix['DEFAULT_SCALE'] = yes
     refpix['centered'] = no
     refpix['skew_coeffs'] = skew_coeffs
-    # Now that we know which row to look at, read coefficients into the
-    #   numeric arrays we have set up...
-    # Setup which column name convention the IDCTAB follows
-    # either: A,B or CX,CY
-    if 'CX10' in ftab[1].data.names:
-        cxstr = 'CX'
-        cystr = 'CY'
-    else:
-        cxstr = 'A'
-        cystr = 'B'
-
-    for i in range(norder+1):
-        if i > 0:
-            for j in range(i+1):
-                xcname = cxstr+str(i)+str(j)
-                ycname = cystr+str(i)+str(j)
-                fx[i,j] = ftab[1].data.field(xcname)[row]
-                fy[i,j] = ftab[1].data.field(ycname)[row]
 
-    ftab.close()
-    del ftab
+    # The coefficients are shared by all users of the index, return copies
+    fx = idcindex.fx[row].copy()
+    fy = idcindex.fy[row].copy()
 
     # If CX11 is 1.0 and not equal to the PSCALE, then the
     # coeffs need to be scaled
@@ -247,6 +171,128 @@ def readIDCtab (tabname, chip=1, date=None, direction='forward',
     # Return arrays and polynomial order read in from table.
     # NOTE: XREF and YREF are stored in Fx,Fy arrays respectively.
     return fx,fy,refpix,order
+
+
+class IDCTabIndex(object):
+    """
+    An index of the rows of an IDCTAB.
+
+    All columns are read once and the coefficients of all rows are stored
+    in (nrows, order+1, order+1) arrays. The rows are indexed by
+    (filter1, filter2, direction, chip), so finding the row for a chip is a
+    dictionary lookup. Instances are cached by `refcache`, one per table.
+
+    Parameters
+    ----------
+    tabname : str
+        Name of the IDCTAB.
+    """
+    def __init__(self, tabname):
+        # the table is read here and not kept in the reference file cache,
+        # the index holds all that is needed from it
+        ftab = refcache.load_fits(tabname)
+        phdr = ftab['PRIMARY'].header
+        self.phdr = phdr
+
+        if 'DETECTOR' in phdr:
+            self.detector = phdr['DETECTOR']
+        else:
+            if 'CAMERA' in phdr:
+                self.detector = str(phdr['CAMERA'])
+            else:
+                self.detector = 1
+
+        # Read FITS header to determine order of fit, i.e. k
+        norder = phdr['NORDER']
+        self.norder = norder
+        if norder < 3:
+            self.order = 3
+        else:
+            self.order = norder
+
+        data = ftab[1].data
+        nrows = data.shape[0]
+        colnames = data.names
+        self.columns = dict([(name, data.field(name)) for name in colnames])
+        columns = self.columns
+
+        def clear(filt):
+            if filt.find('CLEAR') > -1: filt = filt[:5]
+            return filt
+
+        # Determine the filters of each row. None means that the table
+        # does not constrain the filter and all rows match the input filter.
+        if 'FILTER1' in colnames and 'FILTER2' in colnames:
+            filt1 = [clear(f) for f in columns['FILTER1']]
+            filt2 = [clear(f) for f in columns['FILTER2']]
+        elif 'OPT_ELEM' in colnames:
+            # the OPT_ELEM column can not be compared row by row,
+            # assume all rows apply
+            filt1 = [None] * nrows
+            filt2 = [None] * nrows
+        elif 'FILTER' in colnames:
+            filt1 = [clear(f) for f in columns['FILTER']]
+            filt2 = ['CLEAR'] * nrows
+        else:
+            filt1 = [None] * nrows
+            filt2 = [None] * nrows
+        self._match_filter1 = filt1[0] is not None if nrows else False
+        self._match_filter2 = filt2[0] is not None if nrows else False
+
+        if 'DETCHIP' in colnames:
+            detchip = []
+            for c in columns['DETCHIP']:
+                if not str(c).isdigit():
+                    c = 1
+                detchip.append(int(c))
+        else:
+            detchip = [1] * nrows
+        self.detchip = detchip
+
+        if 'DIRECTION' in colnames:
+            direct = [d.lower().strip() for d in columns['DIRECTION']]
+        else:
+            direct = ['forward'] * nrows
+
+        # The first row matching a key is used
+        self._index = {}
+        for i in range(nrows):
+            self._index.setdefault((filt1[i], filt2[i], direct[i], detchip[i]), i)
+
+        # Setup which column name convention the IDCTAB follows
+        # either: A,B or CX,CY
+        if 'CX10' in colnames:
+            cxstr = 'CX'
+            cystr = 'CY'
+        else:
+            cxstr = 'A'
+            cystr = 'B'
+
+        order = self.order
+        self.fx = np.zeros(shape=(nrows,order+1,order+1),dtype=np.float64)
+        self.fy = np.zeros(shape=(nrows,order+1,order+1),dtype=np.float64)
+        for i in range(1, norder+1):
+            for j in range(i+1):
+                self.fx[:,i,j] = columns[cxstr+str(i)+str(j)]
+                self.fy[:,i,j] = columns[cystr+str(i)+str(j)]
+
+    def find_row(self, filter1, filter2, chip, direction='forward'):
+        """
+        Return the index of the first row matching the input,
+        or -1 if no row matches.
+        """
+        f1 = f2 = None
+        if self._match_filter1:
+            f1 = filter1.strip()
+        if self._match_filter2:
+            f2 = filter2.strip()
+        rows = [self._index.get((f1, f2, direction.strip(), c), -1)
+                for c in (int(chip), -999)]
+        rows = [r for r in rows if r >= 0]
+        if rows:
+            return min(rows)
+        return -1
+
 #
 #
 # Time-dependent skew correction coefficients (only ACS/WFC)
@@ -343,7 +389,7 @@ def readOfftab(offtab, date, chip=None):
 
     # Open up IDC table now...
     try:
-        ftab = fileutil.openImage(offtab)
+        ftab = refcache.get_reference(offtab)
     except:
         raise IOError("Offset table '%s' not valid as specified!" % offtab)
 
@@ -400,9 +446,6 @@ def readOfftab(offtab, date, chip=None):
                 row_start = i
                 break
 
-    ftab.close()
-    del ftab
-
     if row_start == None and row_end == None:
         print('Row corresponding to DETCHIP of ',detchip,' was not found!')
         raise LookupError
@@ -650,6 +693,85 @@ def combin(j,n):
     """ Return the combinatorial factor for j in n."""
     return (factorial(j) / (factorial(n) * factorial( (j-n) ) ) )
 
+def evaluate_poly2d(coeffs, x, y, order, out=None, work=None):
+    """
+    Evaluate a 2D polynomial in IDC table convention using Horner's scheme.
+
+    Computes ``sum(coeffs[i,j] * x**j * y**(i-j))`` for i <= order and j <= i.
+    The polynomial is evaluated as a Horner scheme in y whose coefficients
+    are Horner schemes in x, so no powers are computed and all operations
+    are done in place.
+
+    Parameters
+    ----------
+    coeffs : 2D array
+        Coefficients, coeffs[i,j] multiplies x**j * y**(i-j).
+    x, y : arrays
+        Coordinates, float32 or float64. The result has the same precision.
+    order : int
+        Order of the polynomial.
+    out : array, optional
+        Output array with the shape of x, it may be a view (e.g. a column
+        of a (N,2) array). Allocated if not given.
+    work : array, optional
+        Scratch array with the shape of x, allocated if not given.
+        Pass it when calling this function repeatedly on arrays of the
+        same size to avoid the allocation.
+
+    Returns
+    -------
+    out : array
+    """
+    x = np.asanyarray(x)
+    y = np.asanyarray(y)
+    if out is None:
+        out = np.zeros(x.shape, dtype=np.result_type(x, y, np.float32))
+    else:
+        out[...] = 0.
+    if work is None:
+        work = np.empty(x.shape, dtype=out.dtype)
+
+    for k in range(order, -1, -1):
+        # polynomial in x multiplying y**k: sum(coeffs[j+k,j] * x**j)
+        work.fill(coeffs[order, order-k])
+        for j in range(order-k-1, -1, -1):
+            work *= x
+            work += coeffs[j+k, j]
+        out *= y
+        out += work
+    return out
+
+def apply_poly2d(cx, cy, dxy, order, out=None):
+    """
+    Apply a pair of IDC polynomials to an (N,2) array of positions.
+
+    Parameters
+    ----------
+    cx, cy : 2D arrays
+        IDC coefficients for the x and y axes.
+    dxy : (N,2) array
+        Positions relative to the reference pixel.
+    order : int
+        Order of the polynomials.
+    out : (N,2) array, optional
+        Output array, it may be the same as dxy.
+
+    Returns
+    -------
+    out : (N,2) array
+    """
+    if out is None:
+        out = np.empty(dxy.shape, dtype=np.result_type(dxy, np.float32))
+    if out is dxy:
+        # the input is needed for both axes
+        dxy = dxy.copy()
+    x = dxy[:,0]
+    y = dxy[:,1]
+    work = np.empty(x.shape, dtype=out.dtype)
+    evaluate_poly2d(cx, x, y, order, out=out[:,0], work=work)
+    evaluate_poly2d(cy, x, y, order, out=out[:,1], work=work)
+    return out
+
 
 def defaultModel():
     """ This function returns a default, non-distorting model
@@ -0,0 +1,167 @@
+"""
+Process-wide cache of reference files.
+
+Reference files (IDCTAB, OFFTAB, NPOLFILE, D2IMFILE) are typically shared by
+all chips of all exposures processed in a session. Instead of reopening and
+reparsing them for every chip, the readers in `stwcs.distortion.mutil` and
+`stwcs.updatewcs` get them from a cache keyed by the expanded path and the
+modification time of the file, so that an updated reference file is reread.
+
+The cache holds a bounded number of entries and evicts the least recently
+used one when it is full. Objects returned from the cache are shared and
+must not be modified by the caller.
+
+Examples
+--------
+>>> from stwcs.distortion import refcache
+>>> ftab = refcache.get_reference('jref$v8q1444sj_idc.fits')
+>>> refcache.cache_info()
+{'hits': 0, 'misses': 1, 'size': 1, 'maxsize': 32}
+
+"""
+from __future__ import absolute_import, division, print_function # confidence high
+
+import os
+import threading
+from collections import OrderedDict
+
+from astropy.io import fits
+from stsci.tools import fileutil
+
+__all__ = ['RefFileCache', 'load_fits', 'get_reference', 'cache_info',
+           'clear_cache']
+
+
+def load_fits(filename):
+    """
+    Read a FITS file into memory and close it.
+
+    All headers and data arrays are read so that the returned
+    `~astropy.io.fits.HDUList` does not depend on the open file.
+    """
+    hdulist = fits.open(filename, memmap=False)
+    try:
+        for hdu in hdulist:
+            hdu.data
+    finally:
+        hdulist.close()
+    return hdulist
+
+
+class RefFileCache(object):
+    """
+    A least recently used cache of reference files.
+
+    Parameters
+    ----------
+    maxsize : int
+        Maximum number of entries kept in the cache.
+
+    Attributes
+    ----------
+    hits : int
+        Number of requests served from the cache.
+    misses : int
+        Number of requests which required reading the file.
+    """
+    def __init__(self, maxsize=32):
+        self._maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def maxsize(self):
+        return self._maxsize
+
+    @maxsize.setter
+    def maxsize(self, value):
+        with self._lock:
+            self._maxsize = value
+            self._evict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, filename, loader=None):
+        """
+        Return the content of a reference file.
+
+        Parameters
+        ----------
+        filename : str
+            Name of the reference file, IRAF style environment variables
+            (e.g. 'jref$') are expanded.
+        loader : callable, optional
+            Function called with the expanded file name to read the file.
+            Defaults to `load_fits`. Each loader has its own cache entry,
+            so a loader may return an object derived from the file (an index,
+            a parsed model, ...) instead of the file itself.
+        """
+        if loader is None:
+            loader = load_fits
+        fname = os.path.abspath(fileutil.osfn(filename))
+        try:
+            mtime = os.path.getmtime(fname)
+        except OSError:
+            raise IOError("Reference file %s was not found" % filename)
+        key = (fname, mtime, loader)
+        with self._lock:
+            try:
+                value = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                value = loader(fname)
+            else:
+                self.hits += 1
+            self._entries[key] = value
+            self._evict()
+        return value
+
+    def _evict(self):
+        while len(self._entries) > max(self._maxsize, 0):
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        """
+        Remove all entries and reset the counters.
+        """
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def info(self):
+        """
+        Return a dictionary with the cache statistics.
+        """
+        return {'hits': self.hits, 'misses': self.misses,
+                'size': len(self._entries), 'maxsize': self._maxsize}
+
+
+# The cache shared by all readers in this process
+refcache = RefFileCache()
+
+
+def get_reference(filename, loader=None):
+    """
+    Return the content of a reference file from the process-wide cache.
+
+    See `RefFileCache.get`.
+    """
+    return refcache.get(filename, loader=loader)
+
+
+def cache_info():
+    """
+    Return the hit/miss counters and size of the process-wide cache.
+    """
+    return refcache.info()
+
+
+def clear_cache():
+    """
+    Empty the process-wide cache.
+    """
+    refcache.clear()
@@ -0,0 +1,434 @@
+"""
+Store of distortion lookup tables shared between processes.
+
+NPOL and D2IM lookup tables are the largest part of an `HSTWCS` object.
+A `TableStore` keeps each distinct table once, as a ``.npy`` file in a
+directory which is by default created in shared memory (``/dev/shm``)
+when available. Tables are addressed by a key derived from their content,
+so the same table stored twice gets the same key.
+
+When a store is made the default store with `set_default_store`, pickled
+`~stwcs.wcsutil.HSTWCS` objects refer to their lookup tables by store
+directory and key instead of carrying the arrays. A process unpickling such
+an object attaches to the store with `open_store`, reads the table through
+a read-only memory map and builds the lookup table object once per key.
+
+The NPOL and D2IM readers in `stwcs.updatewcs` also get the arrays of the
+reference files through the default store (see `reference_table`). This
+is how the worker processes of ``updatewcs(..., nprocs=N)`` share one
+copy of each reference table.
+
+Files updated with ``updatewcs(..., table_store=path)`` do not embed the
+lookup tables: their WCSDVARR and D2IMARR extensions have no data and record
+the key of the table (``DVARRKEY``) and the store directory (``DVARRDIR``).
+`resolve_tables` substitutes the tables when such a file is read by
+`~stwcs.wcsutil.HSTWCS`. Stores are looked up in the directories given by
+`set_search_path` (or the ``STWCS_TABLE_PATH`` environment variable) and
+then in the recorded directory, so a store may be moved.
+
+Examples
+--------
+>>> from stwcs.distortion import tablestore
+>>> store = tablestore.TableStore()
+>>> tablestore.set_default_store(store)
+>>> # HSTWCS objects sent to worker processes now refer to store.path
+>>> store.cleanup()
+
+"""
+from __future__ import absolute_import, division, print_function # confidence high
+
+import os
+import shutil
+import hashlib
+import tempfile
+import threading
+import weakref
+
+import numpy as np
+from astropy.io import fits
+from astropy.wcs import DistortionLookupTable
+from stsci.tools import fileutil
+
+from . import modelcache
+
+import logging
+logger = logging.getLogger('stwcs.distortion.tablestore')
+
+__all__ = ['TableStore', 'table_key', 'reference_table', 'open_store',
+           'set_default_store', 'get_default_store', 'external_table_hdu',
+           'is_external', 'find_table', 'resolve_tables', 'set_search_path']
+
+# Keywords of a lookup table extension (WCSDVARR, D2IMARR) whose data is
+# kept in a table store instead of the file
+TABLE_KEY_KW = 'DVARRKEY'
+TABLE_DIR_KW = 'DVARRDIR'
+
+_default_store = None
+
+# directories searched for external lookup tables before the directory
+# recorded in the file
+_search_path = [p for p in os.environ.get('STWCS_TABLE_PATH', '').split(os.pathsep)
+                if p]
+
+# stores attached to in this process, keyed by directory
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def _shared_dir():
+    """
+    Return the directory in which stores are created by default.
+    """
+    shm = '/dev/shm'
+    if os.path.isdir(shm) and os.access(shm, os.W_OK):
+        return shm
+    return tempfile.gettempdir()
+
+
+def table_key(data):
+    """
+    Return the content key of a table.
+    """
+    data = np.ascontiguousarray(data)
+    sha = hashlib.sha1()
+    sha.update(str(data.dtype.str).encode('ascii'))
+    sha.update(str(data.shape).encode('ascii'))
+    sha.update(data.tobytes())
+    return sha.hexdigest()
+
+
+class TableStore(object):
+    """
+    A directory of lookup tables addressed by content.
+
+    Parameters
+    ----------
+    path : str or None
+        Directory of the store. If None, a new directory is created in
+        ``/dev/shm`` (or the temporary directory if shared memory is not
+        available) and removed by `cleanup`.
+
+    Notes
+    -----
+    Arrays returned by the store are read-only and shared by all users
+    in a process.
+    """
+    def __init__(self, path=None):
+        if path is None:
+            path = tempfile.mkdtemp(prefix='stwcs-tables-', dir=_shared_dir())
+            self._owner = True
+        else:
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            self._owner = False
+        self.path = os.path.abspath(path)
+        self._lock = threading.RLock()
+        # id(array) -> (weak reference to array, key) for arrays already
+        # stored or read; entries are removed when the array is freed, so
+        # that the store does not keep the arrays of every file alive
+        self._keys = {}
+        self._arrays = {}
+        self._tables = {}
+
+    def __repr__(self):
+        return "<%s %s>" % (self.__class__.__name__, self.path)
+
+    def _filename(self, key):
+        return os.path.join(self.path, key + '.npy')
+
+    def put(self, data):
+        """
+        Add a table to the store and return its key.
+        """
+        with self._lock:
+            key = self.key_of(data)
+            if key is not None:
+                return key
+            key = table_key(data)
+            fname = self._filename(key)
+            if not os.path.exists(fname):
+                self._write(fname, data)
+            self._remember(data, key)
+            return key
+
+    def _remember(self, data, key):
+        i = id(data)
+        keys = self._keys
+
+        def forget(ref):
+            # the id may only be reused once the array is freed
+            if keys.get(i, (None,))[0] is ref:
+                del keys[i]
+        try:
+            keys[i] = (weakref.ref(data, forget), key)
+        except TypeError:
+            # not an ndarray (e.g. a list), its key is computed each time
+            pass
+
+    def get(self, key):
+        """
+        Return the table with this key as a read-only memory mapped array.
+        """
+        with self._lock:
+            data = self._arrays.get(key)
+            if data is None:
+                try:
+                    data = np.load(self._filename(key), mmap_mode='r')
+                except (IOError, OSError):
+                    raise KeyError("Table %s is not in store %s" %
+                                   (key, self.path))
+                self._arrays[key] = data
+                self._remember(data, key)
+            return data
+
+    def _named_filename(self, name):
+        digest = hashlib.sha1(name.encode('utf-8')).hexdigest()
+        return os.path.join(self.path, 'ref-' + digest + '.npy')
+
+    def get_named(self, name):
+        """
+        Return the table stored under name, or None if there is none.
+        """
+        with self._lock:
+            data = self._arrays.get(name)
+            if data is None:
+                fname = self._named_filename(name)
+                if not os.path.exists(fname):
+                    return None
+                data = np.load(fname, mmap_mode='r')
+                self._arrays[name] = data
+            return data
+
+    def put_named(self, name, data):
+        """
+        Store a table under name and return it as stored.
+
+        If another process stored a table under the same name first,
+        that table is kept.
+        """
+        with self._lock:
+            fname = self._named_filename(name)
+            if not os.path.exists(fname):
+                self._write(fname, data)
+            return self.get_named(name)
+
+    def _write(self, fname, data):
+        # Write to a temporary file and rename it so that other
+        # processes never see a partially written table.
+        fd, tmpname = tempfile.mkstemp(suffix='.npy', dir=self.path)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, np.ascontiguousarray(data))
+            os.rename(tmpname, fname)
+        except (IOError, OSError):
+            if os.path.exists(tmpname):
+                os.remove(tmpname)
+            raise
+
+    def lookup_table(self, key, crpix, crval, cdelt):
+        """
+        Return a `~astropy.wcs.DistortionLookupTable` for a stored table.
+
+        The object is built once per table and axis parameters and
+        shared by all callers.
+        """
+        tkey = (key, tuple(crpix), tuple(crval), tuple(cdelt))
+        with self._lock:
+            table = self._tables.get(tkey)
+            if table is None:
+                table = DistortionLookupTable(self.get(key), crpix, crval,
+                                              cdelt)
+                self._tables[tkey] = table
+                self._remember(table.data, key)
+            return table
+
+    def key_of(self, data):
+        """
+        Return the key of an array read from or put in this store,
+        None otherwise.
+        """
+        known = self._keys.get(id(data))
+        if known is not None and known[0]() is data:
+            return known[1]
+        return None
+
+    def __contains__(self, key):
+        return os.path.exists(self._filename(key))
+
+    def keys(self):
+        """
+        Return the keys of all tables in the store.
+        """
+        return [f[:-4] for f in os.listdir(self.path)
+                if f.endswith('.npy') and not f.startswith(('ref-', 'tmp'))]
+
+    def cleanup(self):
+        """
+        Forget all tables and remove the directory if this object created it.
+        """
+        global _default_store
+        if _default_store is self:
+            _default_store = None
+        with self._lock:
+            self._keys.clear()
+            self._arrays.clear()
+            self._tables.clear()
+            if self._owner and os.path.isdir(self.path):
+                shutil.rmtree(self.path, ignore_errors=True)
+        with _stores_lock:
+            if _stores.get(self.path) is self:
+                del _stores[self.path]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.cleanup()
+
+
+def reference_table(reffile, extname, chip, reader):
+    """
+    Return a lookup table array of a reference file.
+
+    If a default store is set, the table is read from the store under a
+    name made of the reference file identity (see
+    `stwcs.distortion.modelcache.file_signature`), extname and chip, so
+    that all processes attached to the store share one read-only copy.
+    The first process which needs the table reads it with
+    ``reader(reffile, extname, chip)`` and adds it to the store. Without a
+    default store, the result of reader is returned.
+    """
+    store = _default_store
+    if store is None:
+        return reader(reffile, extname, chip)
+    try:
+        name = '%s:%s:%s' % (modelcache.file_signature(reffile), extname, chip)
+    except OSError:
+        # a missing reference file is reported by the reader
+        return reader(reffile, extname, chip)
+    data = store.get_named(name)
+    if data is None:
+        data = reader(reffile, extname, chip)
+        if data is not None:
+            data = store.put_named(name, data)
+    return data
+
+
+def open_store(path, create=False):
+    """
+    Return the store in directory path, shared by all callers in a process.
+
+    If create is True, the directory is created if it does not exist.
+    """
+    path = os.path.abspath(fileutil.osfn(path))
+    with _stores_lock:
+        store = _stores.get(path)
+        if store is None:
+            if not create and not os.path.isdir(path):
+                raise IOError("Table store %s does not exist" % path)
+            store = TableStore(path)
+            _stores[path] = store
+        return store
+
+
+def set_default_store(store):
+    """
+    Set the store used when pickling WCS objects, None to embed the tables.
+    """
+    global _default_store
+    if store is not None:
+        with _stores_lock:
+            _stores.setdefault(store.path, store)
+    _default_store = store
+
+
+def get_default_store():
+    """
+    Return the default store or None.
+    """
+    return _default_store
+
+
+def set_search_path(paths):
+    """
+    Set the list of store directories searched for external lookup tables.
+
+    The directories are searched in order, before the directory recorded
+    in the extension header. The initial value is read from the
+    ``STWCS_TABLE_PATH`` environment variable.
+    """
+    global _search_path
+    if isinstance(paths, str):
+        paths = [paths]
+    _search_path = list(paths or [])
+
+
+def external_table_hdu(header, data, store):
+    """
+    Return a header-only HDU for a lookup table kept in store.
+
+    The table is added to store, and the HDU records its key and the
+    directory of the store in the ``DVARRKEY`` and ``DVARRDIR`` keywords.
+
+    Parameters
+    ----------
+    header : `astropy.io.fits.Header`
+        Header of the WCSDVARR or D2IMARR extension.
+    data : ndarray
+        The lookup table.
+    store : `TableStore`
+    """
+    key = store.put(data)
+    hdr = header.copy()
+    hdr[TABLE_KEY_KW] = (key, 'Key of the lookup table in the table store')
+    hdr[TABLE_DIR_KW] = (store.path, 'Directory of the table store')
+    return fits.ImageHDU(header=hdr)
+
+
+def is_external(hdu):
+    """
+    Return True if hdu is a lookup table extension without data whose
+    table is kept in a store.
+    """
+    return TABLE_KEY_KW in hdu.header and hdu.header.get('NAXIS', 0) == 0
+
+
+def find_table(key, path=None):
+    """
+    Return a table by key, searching the search path and then path.
+    """
+    dirs = list(_search_path)
+    if path:
+        dirs.append(path)
+    for d in dirs:
+        try:
+            store = open_store(d)
+        except IOError:
+            continue
+        if key in store:
+            return store.get(key)
+    raise IOError("Lookup table %s was not found in the table stores %s" %
+                  (key, dirs))
+
+
+def resolve_tables(hdulist):
+    """
+    Return an HDUList in which external lookup tables have data.
+
+    If hdulist has no external lookup table extensions it is returned as
+    is, otherwise a new HDUList sharing the other HDUs with hdulist is
+    returned, in which each external table is replaced by an HDU holding
+    the table read from its store. Tables are read through read-only
+    memory maps and cached per process by the stores.
+    """
+    if not isinstance(hdulist, fits.HDUList):
+        return hdulist
+    external = [i for i, hdu in enumerate(hdulist) if is_external(hdu)]
+    if not external:
+        return hdulist
+    hdus = list(hdulist)
+    for i in external:
+        hdr = hdulist[i].header
+        data = find_table(hdr[TABLE_KEY_KW], hdr.get(TABLE_DIR_KW))
+        hdus[i] = fits.ImageHDU(data=data, header=hdr.copy())
+    return fits.HDUList(hdus)
@@ -11,6 +11,8 @@ from stwcs import updatewcs
 from numpy import sqrt, arctan2
 from stsci.tools import fileutil
 
+from . import mutil
+
 def output_wcs(list_of_wcsobj, ref_wcs=None, owcs=None, undistort=True):
     """
     Create an output WCS.
@@ -38,18 +40,18 @@ def output_wcs(list_of_wcsobj, ref_wcs=None, owcs=None, undistort=True):
     crval = np.array([crval1,crval2], dtype=np.float64) # this value is now zero-based
     if owcs is None:
         if ref_wcs is None:
-            ref_wcs = list_of_wcsobj[0].deepcopy()
+            ref_wcs = copy_wcs(list_of_wcsobj[0])
         if undistort:
             #outwcs = undistortWCS(ref_wcs)
             outwcs = make_orthogonal_cd(ref_wcs)
         else:
-            outwcs = ref_wcs.deepcopy()
+            outwcs = copy_wcs(ref_wcs)
         outwcs.wcs.crval = crval
         outwcs.wcs.set()
         outwcs.pscale = sqrt(outwcs.wcs.cd[0,0]**2 + outwcs.wcs.cd[1,0]**2)*3600.
         outwcs.orientat = arctan2(outwcs.wcs.cd[0,1],outwcs.wcs.cd[1,1]) * 180./np.pi
     else:
-        outwcs = owcs.deepcopy()
+        outwcs = copy_wcs(owcs)
         outwcs.pscale = sqrt(outwcs.wcs.cd[0,0]**2 + outwcs.wcs.cd[1,0]**2)*3600.
         outwcs.orientat = arctan2(outwcs.wcs.cd[0,1],outwcs.wcs.cd[1,1]) * 180./np.pi
 
@@ -73,6 +75,14 @@ def output_wcs(list_of_wcsobj, ref_wcs=None, owcs=None, undistort=True):
     outwcs.wcs.name = wcsname # keep track of label for this solution
     return outwcs
 
+def copy_wcs(wcsobj):
+    """
+    Copy a WCS object, sharing the distortion model of HSTWCS objects.
+    """
+    if isinstance(wcsobj, wcsutil.HSTWCS):
+        return wcsobj.clone()
+    return wcsobj.deepcopy()
+
 def computeFootprintCenter(edges):
     """ Geographic midpoint in spherical coords for points defined by footprints.
         Algorithm derived from: http://www.geomidpoint.com/calculation.html
@@ -246,12 +256,7 @@ def apply_idc(pixpos, cx, cy, pixref, pscale= None, order=None):
 
     dxy = _p - pixref
     # Apply coefficients from distortion model here...
-
-    c = _p * 0.
-    for i in range(order+1):
-        for j in range(i+1):
-            c[:,0] = c[:,0] + _cx[i][j] * pow(dxy[:,0],j) * pow(dxy[:,1],(i-j))
-            c[:,1] = c[:,1] + _cy[i][j] * pow(dxy[:,0],j) * pow(dxy[:,1],(i-j))
+    c = mutil.apply_poly2d(_cx, _cy, dxy, order)
 
     return  c
 
@@ -16,4 +16,5 @@ from . import headerlet_summary
 from . import archive_headerlet
 from . import restore_headerlet
 from . import apply_headerlet
+from . import apply_headerlets
 from . import updatewcs
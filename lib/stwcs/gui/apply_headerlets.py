@@ -0,0 +1,110 @@
+import os
+from stsci.tools import teal
+
+import stwcs
+from stwcs.wcsutil import headerlet
+
+__taskname__ = __name__.split('.')[-1] # needed for help string
+__package__ = headerlet.__name__
+__version__ = stwcs.__version__
+#
+#### Interfaces used by TEAL
+#
+def getHelpAsString(docstring=False):
+    """
+    return useful help from a file in the script directory called __taskname__.help
+    """
+    install_dir = os.path.dirname(__file__)
+    htmlfile = os.path.join(install_dir,'htmlhelp',__taskname__+'.html')
+    helpfile = os.path.join(install_dir,__taskname__+'.help')
+    if docstring or (not docstring and not os.path.exists(htmlfile)):
+        helpString = __taskname__+' Version '+__version__+'\n\n'
+        if os.path.exists(helpfile):
+            helpString += teal.getHelpFileAsString(__taskname__,__file__)
+        else:
+            helpString += headerlet.apply_headerlets.__doc__
+    else:
+        helpString = 'file://'+htmlfile
+
+    return helpString
+
+def run(configObj=None):
+
+    wcsname = configObj['wcsname']
+    if wcsname in ['',' ','INDEF']: wcsname = None
+    wcskey = configObj['wcskey']
+    if wcskey == '': wcskey = None
+    nprocs = configObj['nprocs']
+    if nprocs == 0: nprocs = None
+    # Call function with properly interpreted input parameters
+    # Syntax: apply_headerlets(hdrlets, filenames, primary=True, attach=True,
+    #            archive=True, force=False, wcskey=None, wcsname=None,
+    #            nprocs=1, logging=False)
+    report = headerlet.apply_headerlets(configObj['hdrlets'],
+                        configObj['filenames'], primary=configObj['primary'],
+                        attach=configObj['attach'],
+                        archive=configObj['archive'], force=configObj['force'],
+                        wcskey=wcskey, wcsname=wcsname, nprocs=nprocs,
+                        logging=configObj['logging'])
+    print_report(report)
+    return report
+
+def print_report(report):
+    """
+    Print the outcome of `~stwcs.wcsutil.headerlet.apply_headerlets`
+    as a table, one line per science file or unmatched headerlet.
+    """
+    for r in report:
+        fname = r['filename'] or '-'
+        hdrlets = ','.join([os.path.basename(h) for h in r['hdrlets']]) or '-'
+        print('%-40s %-8s %7.2f  %s' % (fname, r['status'], r['time'], hdrlets))
+        if r['error']:
+            # first line of the exception message, after the stack frames
+            lines = r['error'].splitlines()
+            frames = [i for i, l in enumerate(lines) if l.startswith(' ')]
+            print('    ' + lines[frames[-1] + 1 if frames else 0])
+
+def main(args=None):
+    """
+    Command line interface:
+
+        python -m stwcs.gui.apply_headerlets HDRLETS FILENAMES [options]
+
+    The exit status is 1 if any file failed.
+    """
+    import argparse
+    parser = argparse.ArgumentParser(prog='apply_headerlets',
+        description="Apply headerlets to the science files with ROOTNAME "
+                    "equal to their DESTIM.")
+    parser.add_argument('hdrlets', help="headerlet files: a directory, "
+                        "wild cards, a comma separated list or an @-file")
+    parser.add_argument('filenames', help="science files, same forms as hdrlets")
+    parser.add_argument('--alternate', action='store_true',
+                        help="apply as alternate WCS instead of primary WCS")
+    parser.add_argument('--no-attach', dest='attach', action='store_false',
+                        help="do not append the headerlets to the files")
+    parser.add_argument('--no-archive', dest='archive', action='store_false',
+                        help="do not save the primary WCS as a headerlet")
+    parser.add_argument('--force', action='store_true',
+                        help="replace the primary WCS even if the distortion "
+                        "models differ")
+    parser.add_argument('--wcskey', default=None,
+                        help="key of the alternate WCS")
+    parser.add_argument('--wcsname', default=None,
+                        help="name of the alternate WCS")
+    parser.add_argument('-n', '--nprocs', type=int, default=1,
+                        help="number of worker processes, 0 for all CPUs")
+    parser.add_argument('--logging', action='store_true',
+                        help="write a log file (headerlet.log)")
+    opts = parser.parse_args(args)
+    report = headerlet.apply_headerlets(opts.hdrlets, opts.filenames,
+                        primary=not opts.alternate, attach=opts.attach,
+                        archive=opts.archive, force=opts.force,
+                        wcskey=opts.wcskey, wcsname=opts.wcsname,
+                        nprocs=opts.nprocs or None, logging=opts.logging)
+    print_report(report)
+    return int(any([r['status'] == 'FAILED' for r in report]))
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(main())
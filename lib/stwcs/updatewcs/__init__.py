@@ -12,8 +12,13 @@ from . import utils, corrections, makewcs
 from . import npol, det2im
 from stsci.tools import parseinput, fileutil
 from . import apply_corrections
+from stwcs.distortion import tablestore, modelcache
+from stwcs.wcsutil.mappings import basic_wcs
 
+import os
+import json
 import time
+import hashlib
 import logging
 logger = logging.getLogger('stwcs.updatewcs')
 
@@ -23,7 +28,9 @@ atexit.register(logging.shutdown)
 #Note: The order of corrections is important
 
 def updatewcs(input, vacorr=True, tddcorr=True, npolcorr=True, d2imcorr=True,
-              checkfiles=True, verbose=False):
+              checkfiles=True, verbose=False, nprocs=1, invsip=False,
+              invsip_order=None, table_store=None, force=False,
+              report=False):
     """
 
     Updates HST science files with the best available calibration information.
@@ -48,7 +55,14 @@ def updatewcs(input, vacorr=True, tddcorr=True, npolcorr=True, d2imcorr=True,
     Parameters
     ----------
     input: a python list of file names or a string (wild card characters allowed)
-             input files may be in fits, geis or waiver fits format
+             input files may be in fits, geis or waiver fits format.
+             An `astropy.io.fits.HDUList` or a list of them may be given
+             instead, they are updated in memory and nothing is written to
+             disk (the caller writes or closes them); checkfiles and nprocs
+             are then ignored. Such objects must be created in memory (for
+             example read with ``fits.HDUList([hdu.copy() for hdu in f])``)
+             or opened in 'update' mode, in which case the changes are
+             written when the caller closes them.
     vacorr: boolean
               If True, vecocity aberration correction will be applied
     tddcorr: boolean
@@ -61,6 +75,50 @@ def updatewcs(input, vacorr=True, tddcorr=True, npolcorr=True, d2imcorr=True,
               If True, the format of the input files will be checked,
               geis and waiver fits files will be converted to MEF format.
               Default value is True for standalone mode.
+    nprocs: int
+              Number of worker processes used to update the files.
+              If 1 (default), files are processed serially in this process and
+              the first failure stops the run. If greater than 1 (or None to use
+              all available CPUs), files are distributed over a pool of worker
+              processes and a failure in one file does not affect the others
+              (see report). The log messages of each file are written as
+              one block. A file listed more than once is updated once.
+    invsip: boolean
+              If True, inverse SIP polynomials (AP_i_j, BP_i_j) are fitted to the
+              full distortion model, including the lookup table corrections,
+              and written to the headers of the science extensions.
+    invsip_order: int or None
+              Order of the inverse SIP polynomials. Default is the order of the
+              forward SIP polynomials plus one.
+    table_store: str or None
+              Directory of a lookup table store (see `stwcs.distortion.tablestore`).
+              If given, the NPOL and D2IM lookup tables are stored once in this
+              directory and the WCSDVARR/D2IMARR extensions of the science files
+              only refer to them by content key. Such files can be read by
+              `~stwcs.wcsutil.HSTWCS` where the store is available, but not by
+              software unaware of the store. If None (default), the tables are
+              embedded in each file.
+    force: boolean
+              If False (default), files whose fingerprint (keyword UPWCSFP,
+              see `fingerprint`) shows that they were updated with the same
+              reference files, OPUS WCS, options and STWCS version, and
+              whose WCS was not changed since, are skipped (see report).
+              If True, all files are updated.
+    report: boolean
+              If True, a per-file report is returned with the files.
+
+    Returns
+    -------
+    files: list
+              Names of the input files, or the updated HDUList objects
+              (in-memory input)
+    report: list of dictionaries
+              Only if report is True: one dictionary per file, in the order
+              of files, with keys 'filename' (None for in-memory files),
+              'status' ('OK', 'SKIPPED' or 'FAILED'), 'error' (the traceback
+              of the failure or None) and 'time' (processing time in seconds).
+              Failures are reported only in parallel mode, the serial mode
+              stops at the first one.
     """
     if verbose == False:
         logger.setLevel(100)
@@ -73,10 +131,22 @@ def updatewcs(input, vacorr=True, tddcorr=True, npolcorr=True, d2imcorr=True,
         logger.addHandler(fh)
         logger.setLevel(verbose)
     args = "vacorr=%s, tddcorr=%s, npolcorr=%s, d2imcorr=%s, checkfiles=%s, \
-    " % (str(vacorr), str(tddcorr), str(npolcorr),
-                                          str(d2imcorr), str(checkfiles))
+    invsip=%s, table_store=%s, force=%s" % (str(vacorr), str(tddcorr), str(npolcorr),
+                                          str(d2imcorr), str(checkfiles),
+                                          str(invsip), str(table_store), str(force))
     logger.info('\n\tStarting UPDATEWCS: %s', time.asctime())
 
+    if isinstance(input, fits.HDUList):
+        input = [input]
+    if isinstance(input, list) and any(isinstance(i, fits.HDUList) for i in input):
+        if not all(isinstance(i, fits.HDUList) for i in input):
+            raise TypeError("Input must be file names or HDUList objects, not both")
+        logger.info("\n\tInput arguments: %s" %args)
+        results = _update_hdulists(input, vacorr, tddcorr, npolcorr, d2imcorr,
+                                   nprocs, invsip, invsip_order, table_store,
+                                   force)
+        return (input, results) if report else input
+
     files = parseinput.parseinput(input)[0]
     logger.info("\n\tInput files: %s, " % [i for i in files])
     logger.info("\n\tInput arguments: %s" %args)
@@ -85,32 +155,184 @@ def updatewcs(input, vacorr=True, tddcorr=True, npolcorr=True, d2imcorr=True,
         if not files:
             print('No valid input, quitting ...\n')
             return
+    files = _unique_files(files)
+
+    if nprocs is None or nprocs > 1:
+        results = _update_parallel(files, vacorr, tddcorr, npolcorr, d2imcorr,
+                                   nprocs, invsip, invsip_order, table_store,
+                                   force)
+    else:
+        results = [_update_serial(f, vacorr, tddcorr, npolcorr, d2imcorr,
+                                  invsip, invsip_order, table_store, force)
+                   for f in files]
+
+    return (files, results) if report else files
 
+def _unique_files(files):
+    """
+    Remove the names of files already in the list, compared by absolute
+    path, so that no file is updated twice, or by two processes at once.
+    """
+    unique = []
+    paths = set()
     for f in files:
-        acorr = apply_corrections.setCorrections(f, vacorr=vacorr, \
-            tddcorr=tddcorr,npolcorr=npolcorr, d2imcorr=d2imcorr)
-        if 'MakeWCS' in acorr and newIDCTAB(f):
-            logger.warning("\n\tNew IDCTAB file detected. All current WCSs will be deleted")
-            cleanWCS(f)
+        path = os.path.abspath(fileutil.osfn(f))
+        if path not in paths:
+            paths.add(path)
+            unique.append(f)
+    return unique
+
+def _update_serial(fname, *args):
+    """
+    Run `_update_file` for one file in this process and return its
+    report entry (see `updatewcs`); exceptions are not caught.
+    """
+    t0 = time.time()
+    updated = _update_file(fname, *args)
+    if isinstance(fname, fits.HDUList):
+        fname = None
+    return {'filename': fname, 'status': 'OK' if updated else 'SKIPPED',
+            'error': None, 'time': time.time() - t0}
+
+def _update_hdulists(hdulists, vacorr, tddcorr, npolcorr, d2imcorr, nprocs,
+                     invsip, invsip_order, table_store, force):
+    """
+    Update in-memory files in this process.
+    """
+    logger.info("\n\tInput: %d in-memory file(s)", len(hdulists))
+    for f in hdulists:
+        # same rule as the functions of wcsutil.altwcs: changes to a file
+        # opened read-only would be silently lost
+        info = f.fileinfo(0)
+        if info is not None and info['filemode'] != 'update':
+            raise ValueError("HDUList of file %s must be opened in 'update' mode "
+                             "or created in memory" % f.filename())
+    if nprocs is None or nprocs > 1:
+        # copying the files to worker processes and back would cost
+        # more than the update itself
+        logger.info("\n\tIn-memory files are updated serially, nprocs is ignored")
+    return [_update_serial(f, vacorr, tddcorr, npolcorr, d2imcorr, invsip,
+                           invsip_order, table_store, force) for f in hdulists]
+
+def _update_file(fname, vacorr, tddcorr, npolcorr, d2imcorr, invsip=False,
+                 invsip_order=None, table_store=None, force=False):
+    """
+    Determine and apply the corrections for a single file.
 
-        makecorr(f, acorr)
+    fname is a file name or an `astropy.io.fits.HDUList` updated in place.
+    Returns False if the file was skipped because it is up to date,
+    True otherwise.
+    """
+    # The headers are read once and shared by all decision functions
+    hdrs = utils.HeaderSnapshot(fname)
+    name = hdrs.filename or hdrs.getheader(0).get('ROOTNAME', '<in-memory file>')
+    options = {'vacorr': vacorr, 'tddcorr': tddcorr, 'npolcorr': npolcorr,
+               'd2imcorr': d2imcorr, 'invsip': invsip,
+               'invsip_order': invsip_order, 'table_store': table_store or None}
+    if not force:
+        recorded = hdrs.getheader(0).get('UPWCSFP', None)
+        if recorded is not None and recorded == fingerprint(hdrs, options):
+            logger.info("\n\t%s is up to date (UPWCSFP=%s), skipping it",
+                        name, recorded)
+            return False
+    acorr = apply_corrections.setCorrections(hdrs, vacorr=vacorr, \
+        tddcorr=tddcorr,npolcorr=npolcorr, d2imcorr=d2imcorr)
+    if 'MakeWCS' in acorr and newIDCTAB(hdrs):
+        logger.warning("\n\tNew IDCTAB file detected. All current WCSs will be deleted")
+        cleanWCS(fname)
+
+    makecorr(hdrs.source, acorr, invsip=invsip, invsip_order=invsip_order,
+             table_store=table_store, options=options)
+    return True
+
+def _init_worker(store_path):
+    """
+    Pool initializer: workers attach to the table store of the main process.
+    """
+    tablestore.set_default_store(tablestore.open_store(store_path))
 
-    return files
+def _process_file(*args):
+    """
+    Run `_update_file` for one file; used by `utils.run_tasks`.
+    """
+    result = {'filename': args[0]}
+    if not _update_file(*args):
+        result['status'] = 'SKIPPED'
+    return result
+
+def _update_parallel(files, vacorr, tddcorr, npolcorr, d2imcorr,
+                     nprocs=None, invsip=False, invsip_order=None,
+                     table_store=None, force=False):
+    """
+    Update a list of files using a pool of worker processes.
 
-def makecorr(fname, allowed_corr):
+    Files are processed in order of completion; the log records of each
+    file are handled here as one block (see `utils.run_tasks`). The NPOL
+    and D2IM reference tables are shared by the workers through a table
+    store (the default store if one is set, otherwise a temporary one
+    removed at the end).
+    """
+    tasks = [(f, vacorr, tddcorr, npolcorr, d2imcorr, invsip, invsip_order,
+              table_store, force) for f in files]
+    store = tablestore.get_default_store()
+    own_store = store is None
+    if own_store:
+        store = tablestore.TableStore()
+    try:
+        results = utils.run_tasks(_process_file, tasks, logger.name,
+                                  "\n\tFailed to update %s", nprocs=nprocs,
+                                  initializer=_init_worker,
+                                  initargs=(store.path,))
+    finally:
+        if own_store:
+            store.cleanup()
+    report = []
+    for f, result in zip(files, results):
+        result.setdefault('filename', f)
+        report.append(result)
+
+    failed = [r['filename'] for r in report if r['status'] == 'FAILED']
+    skipped = [r for r in report if r['status'] == 'SKIPPED']
+    logger.info("\n\tUpdated %d files, %d skipped (up to date), %d failed",
+                len(report)-len(failed)-len(skipped), len(skipped), len(failed))
+    if failed:
+        logger.warning("\n\tThe following files could not be updated: %s", failed)
+    return report
+
+def makecorr(fname, allowed_corr, invsip=False, invsip_order=None,
+             table_store=None, options=None):
     """
     Purpose
     =======
     Applies corrections to the WCS of a single file
 
     :Parameters:
-    `fname`: string
-             file name
+    `fname`: string or `astropy.io.fits.HDUList`
+             file name, or a file object which is updated in memory
+             and neither written nor closed
     `acorr`: list
              list of corrections to be applied
+    `invsip`: boolean
+             fit and write the inverse SIP coefficients
+    `invsip_order`: int or None
+             order of the inverse SIP polynomials
+    `table_store`: string or None
+             directory of the table store for the lookup tables,
+             None to embed them in the file
+    `options`: dictionary or None
+             the updatewcs options, recorded in the fingerprint of the
+             file (UPWCSFP). If None, any fingerprint is removed.
+
+    Returns fname.
     """
     logger.info("Allowed corrections: {0}".format(allowed_corr))
-    f = fits.open(fname, mode='update')
+    store = None
+    if table_store:
+        store = tablestore.open_store(table_store, create=True)
+    if isinstance(fname, str):
+        f = fits.open(fname, mode='update')
+    else:
+        f = fname
     #Determine the reference chip and create the reference HSTWCS object
     nrefchip, nrefext = getNrefchip(f)
     wcsutil.restoreWCS(f, nrefext, wcskey='O')
@@ -118,7 +340,7 @@ def makecorr(fname, allowed_corr):
     rwcs.readModel(update=True,header=f[nrefext].header)
 
     if 'DET2IMCorr' in allowed_corr:
-        kw2update = det2im.DET2IMCorr.updateWCS(f)
+        kw2update = det2im.DET2IMCorr.updateWCS(f, store=store)
         for kw in kw2update:
             f[1].header[kw] = kw2update[kw]
 
@@ -130,7 +352,7 @@ def makecorr(fname, allowed_corr):
             if  extname == 'sci':
                 wcsutil.restoreWCS(f, ext=i, wcskey='O')
                 sciextver = extn.header['extver']
-                ref_wcs = rwcs.deepcopy()
+                ref_wcs = rwcs.clone()
                 hdr = extn.header
                 ext_wcs = HSTWCS(fobj=f, ext=i)
                 ### check if it exists first!!!
@@ -155,16 +377,21 @@ def makecorr(fname, allowed_corr):
                 cextver = extn.header['extver']
                 if cextver == sciextver:
                     hdr = f[('SCI',sciextver)].header
-                    w = pywcs.WCS(hdr, f)
+                    w = pywcs.WCS(hdr, tablestore.resolve_tables(f))
                     copyWCS(w, extn.header)
 
             else:
                 continue
 
     if 'NPOLCorr' in allowed_corr:
-        kw2update = npol.NPOLCorr.updateWCS(f)
+        kw2update = npol.NPOLCorr.updateWCS(f, store=store)
         for kw in kw2update:
             f[1].header[kw] = kw2update[kw]
+    if invsip:
+        # the lookup tables are in place, fit the complete distortion model
+        for i in range(len(f))[1:]:
+            if f[i].header.get('EXTNAME', '').lower() == 'sci':
+                updateInverseSIP(f, i, order=invsip_order)
     # Finally record the version of the software which updated the WCS
     if 'HISTORY' in f[0].header:
         f[0].header.set('UPWCSVER', value=stwcs.__version__,
@@ -191,13 +418,126 @@ def makecorr(fname, allowed_corr):
             f[0].header.set('PYWCSVER', astropy.__version__,
                             "Version of PYWCS used to updated the WCS",
                             after=i)
+    # Record the fingerprint of the inputs, so that an identical update
+    # can be skipped
+    if options is None:
+        if 'UPWCSFP' in f[0].header:
+            del f[0].header['UPWCSFP']
+    else:
+        fp = fingerprint(utils.HeaderSnapshot(f), options)
+        if 'UPWCSVER' in f[0].header:
+            f[0].header.set('UPWCSFP', fp, "Fingerprint of the inputs of updatewcs",
+                            after='UPWCSVER')
+        else:
+            f[0].header['UPWCSFP'] = (fp, "Fingerprint of the inputs of updatewcs")
     # add additional keywords to be used by headerlets
     distdict = utils.construct_distname(f,rwcs)
     f[0].header['DISTNAME'] = distdict['DISTNAME']
     f[0].header['SIPNAME'] = distdict['SIPNAME']
     # Make sure NEXTEND keyword remains accurate
     f[0].header['NEXTEND'] = len(f)-1
-    f.close()
+    wcsutil.altwcs.closefobj(fname, f)
+    return fname
+
+# Primary and science extension keywords which are inputs of the corrections
+_FP_REFFILE_KW = ['IDCTAB', 'OFFTAB', 'NPOLFILE', 'D2IMFILE', 'DGEOFILE']
+_FP_PRIMARY_KW = ['INSTRUME', 'DETECTOR', 'FILTER1', 'FILTER2', 'FILTNAM1',
+                  'FILTNAM2', 'DATE-OBS', 'TIME-OBS', 'EXPSTART', 'PA_V3',
+                  'RA_TARG', 'DEC_TARG']
+_FP_SCI_KW = ['EXTVER', 'NAXIS1', 'NAXIS2', 'CCDCHIP', 'CAMERA', 'VAFACTOR',
+              'LTV1', 'LTV2', 'LTM1_1', 'LTM2_2', 'BINAXIS1', 'BINAXIS2']
+# Primary WCS written by updatewcs: a file whose WCS was changed afterwards
+# (tweakreg, apply_as_primary, ...) must not be skipped
+_FP_WCS_KW = ['WCSNAME', 'CRVAL1', 'CRVAL2', 'CRPIX1', 'CRPIX2',
+              'CD1_1', 'CD1_2', 'CD2_1', 'CD2_2']
+
+def _reffile_id(value):
+    """
+    Identify a reference file by the checksum of its content.
+    """
+    if not isinstance(value, str) or value.strip().upper() in ['', 'N/A', 'NONE']:
+        return value
+    try:
+        return modelcache.file_signature(fileutil.osfn(value), validate='checksum')
+    except (OSError, IOError):
+        return 'missing:' + value
+
+def _wcs_value(value):
+    # values read back from a file may be rounded by the card format
+    if isinstance(value, float):
+        return '%.12g' % value
+    return value
+
+def _is_opus_kw(key):
+    # keywords of the OPUS WCS, archived with key 'O'
+    if not key.endswith('O') or len(key) < 2:
+        return False
+    root = key[:-1]
+    return root in ['WCSNAME', 'WCSAXES'] or any(root.startswith(k) for k in basic_wcs)
+
+def fingerprint(hdrs, options):
+    """
+    Return a fingerprint of the inputs of an update of a file.
+
+    The fingerprint is a SHA1 checksum of the content of the reference files
+    (IDCTAB, OFFTAB, NPOLFILE, D2IMFILE, DGEOFILE), the primary and science
+    extension keywords used by the corrections, the OPUS WCS and the primary
+    WCS of each science extension, the options of `updatewcs` and the STWCS
+    version. It is recorded in the UPWCSFP keyword when a file is updated,
+    after the new WCS is written; files with a matching fingerprint are
+    skipped by `updatewcs` unless force=True. A file whose WCS was changed
+    since it was updated has a different fingerprint and is updated again.
+
+    Parameters
+    ----------
+    hdrs : str, `astropy.io.fits.HDUList` or `~stwcs.updatewcs.utils.HeaderSnapshot`
+        Science file.
+    options : dict
+        The options of `updatewcs` which change the result.
+    """
+    hdrs = utils.header_snapshot(hdrs)
+    phdr = hdrs.getheader(0)
+    content = [stwcs.__version__, sorted(options.items())]
+    content.append([(k, _reffile_id(phdr.get(k))) for k in _FP_REFFILE_KW])
+    content.append([(k, phdr.get(k)) for k in _FP_PRIMARY_KW])
+    for hdr in hdrs.headers[1:]:
+        if hdr.get('EXTNAME', '').upper() != 'SCI':
+            continue
+        content.append([(k, hdr.get(k)) for k in _FP_SCI_KW])
+        content.append(sorted((k, hdr[k]) for k in hdr if _is_opus_kw(k)))
+        content.append([(k, _wcs_value(hdr.get(k))) for k in _FP_WCS_KW])
+    data = json.dumps(content, default=str, sort_keys=True)
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+def updateInverseSIP(f, ext, order=None):
+    """
+    Fit the inverse SIP polynomials of one extension to its full
+    distortion model and write them to its header.
+
+    Parameters
+    ----------
+    f : `astropy.io.fits.HDUList`
+        File opened in update mode.
+    ext : int
+        Index of the science extension.
+    order : int or None
+        Order of the inverse polynomials, see `HSTWCS.fit_inverse_sip`.
+    """
+    hdr = f[ext].header
+    ext_wcs = HSTWCS(fobj=f, ext=ext)
+    if ext_wcs.sip is None:
+        logger.info("\n\tNo SIP in extension %s, inverse SIP not computed", ext)
+        return
+    residuals = ext_wcs.fit_inverse_sip(order=order)
+    for k in ['AP', 'BP']:
+        for kw in list(hdr.keys()):
+            if kw.startswith(k + '_'):
+                del hdr[kw]
+    for card in ext_wcs._sip2hdr('ap') + ext_wcs._sip2hdr('bp'):
+        hdr[card.keyword] = (card.value, card.comment)
+    logger.info("\n\tInverse SIP of order %d for extension %s: residuals "
+                "rms %.4f, max %.4f pixels", ext_wcs.sip.ap_order, ext,
+                residuals['rms_check'], residuals['max_check'])
 
 def copyWCS(w, ehdr):
     """
@@ -333,11 +673,11 @@ def checkFiles(input):
 
 def newIDCTAB(fname):
     #When this is called we know there's a kw IDCTAB in the header
-    hdul = fits.open(fname)
-    idctab = fileutil.osfn(hdul[0].header['IDCTAB'])
+    hdrs = utils.header_snapshot(fname)
+    idctab = fileutil.osfn(hdrs.getval('IDCTAB'))
     try:
         #check for the presence of IDCTAB in the first extension
-        oldidctab = fileutil.osfn(hdul[1].header['IDCTAB'])
+        oldidctab = fileutil.osfn(hdrs.getval('IDCTAB', ext=1))
     except KeyError:
         return False
     if idctab == oldidctab:
@@ -348,7 +688,12 @@ def newIDCTAB(fname):
 def cleanWCS(fname):
     # A new IDCTAB means all previously computed WCS's are invalid
     # We are deleting all of them except the original OPUS WCS.
-    f = fits.open(fname, mode='update')
+    if isinstance(fname, utils.HeaderSnapshot):
+        fname = fname.source
+    if isinstance(fname, str):
+        f = fits.open(fname, mode='update')
+    else:
+        f = fname
     keys = wcsutil.wcskeys(f[1].header)
     # Remove the primary WCS from the list
     try:
@@ -358,10 +703,11 @@ def cleanWCS(fname):
     fext = list(range(1, len(f)))
     for key in keys:
         try:
-            wcsutil.deleteWCS(fname, ext=fext, wcskey=key)
+            wcsutil.deleteWCS(f, ext=fext, wcskey=key)
         except KeyError:
             # Some extensions don't have the alternate (or any) WCS keywords
             continue
+    wcsutil.altwcs.closefobj(fname, f)
 
 def getCorrections(instrument):
     """
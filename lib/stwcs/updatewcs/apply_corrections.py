@@ -1,11 +1,11 @@
 from __future__ import division, print_function  # confidence high
 
 import os
-from astropy.io import fits
 import time
 from stsci.tools import fileutil
 import os.path
 from stwcs.wcsutil import altwcs
+from stwcs.distortion import refcache
 from . import utils
 from . import wfpc2_dgeo
 
@@ -38,8 +38,13 @@ def setCorrections(fname, vacorr=True, tddcorr=True, npolcorr=True, d2imcorr=Tru
     Creates a list of corrections to be applied to a file
     based on user input paramters and allowed corrections
     for the instrument.
+
+    fname may be a file name or a `~stwcs.updatewcs.utils.HeaderSnapshot`
+    of the file, the headers are read only once and shared by all checks.
     """
-    instrument = fits.getval(fname, 'INSTRUME')
+    hdrs = utils.header_snapshot(fname)
+    fname = hdrs.filename
+    instrument = hdrs.getval('INSTRUME')
     # make a copy of this list !
     acorr = allowed_corrections[instrument][:]
 
@@ -47,25 +52,32 @@ def setCorrections(fname, vacorr=True, tddcorr=True, npolcorr=True, d2imcorr=Tru
     # converted on-the-fly into a proper D2IMFILE here...
     if instrument == 'WFPC2':
         # check for DGEOFILE, and convert it to D2IMFILE if found
-        d2imfile = wfpc2_dgeo.update_wfpc2_d2geofile(fname)
+        if hdrs.hdulist is None:
+            d2imfile = wfpc2_dgeo.update_wfpc2_d2geofile(fname)
+        else:
+            # the converted D2IMFILE is named after the rootname of
+            # an in-memory file
+            name = fname or hdrs.getheader().get('ROOTNAME', 'wfpc2').lower() + '.fits'
+            d2imfile = wfpc2_dgeo.update_wfpc2_d2geofile(name, fhdu=hdrs.hdulist)
+        hdrs.refresh()
     # Check if idctab is present on disk
     # If kw IDCTAB is present in the header but the file is
     # not found on disk, do not run TDDCorr, MakeCWS and CompSIP
-    if not foundIDCTAB(fname):
+    if not foundIDCTAB(hdrs):
         if 'TDDCorr' in acorr: acorr.remove('TDDCorr')
         if 'MakeWCS' in acorr: acorr.remove('MakeWCS')
         if 'CompSIP' in acorr: acorr.remove('CompSIP')
 
     if 'VACorr' in acorr and vacorr==False:  acorr.remove('VACorr')
     if 'TDDCorr' in acorr:
-        tddcorr = applyTDDCorr(fname, tddcorr)
+        tddcorr = applyTDDCorr(hdrs, tddcorr)
         if tddcorr == False: acorr.remove('TDDCorr')
 
     if 'NPOLCorr' in acorr:
-        npolcorr = applyNpolCorr(fname, npolcorr)
+        npolcorr = applyNpolCorr(hdrs, npolcorr)
         if npolcorr == False: acorr.remove('NPOLCorr')
     if 'DET2IMCorr' in acorr:
-        d2imcorr = applyD2ImCorr(fname, d2imcorr)
+        d2imcorr = applyD2ImCorr(hdrs, d2imcorr)
         if d2imcorr == False: acorr.remove('DET2IMCorr')
     logger.info("\n\tCorrections to be applied to %s: %s " % (fname, str(acorr)))
     return acorr
@@ -85,9 +97,9 @@ def foundIDCTAB(fname):
     ------
     IOError : If IDCTAB file not found on disk.
     """
-
+    hdrs = utils.header_snapshot(fname)
     try:
-        idctab = fits.getval(fname, 'IDCTAB').strip()
+        idctab = hdrs.getval('IDCTAB').strip()
         if idctab == 'N/A' or idctab == "":
             return False
     except KeyError:
@@ -108,7 +120,7 @@ def applyTDDCorr(fname, utddcorr):
     - the idc table specified in the primary header is available.
     """
 
-    phdr = fits.getheader(fname)
+    phdr = utils.header_snapshot(fname).getheader()
     instrument = phdr['INSTRUME']
     try:
         detector = phdr['DETECTOR']
@@ -147,12 +159,14 @@ def applyNpolCorr(fname, unpolcorr):
     extension header and the file exists on disk and is a 'new type' npolfile,
     then the lookup tables will be updated as 'WCSDVARR' extensions.
     """
+    hdrs = utils.header_snapshot(fname)
     applyNPOLCorr = True
     try:
         # get NPOLFILE kw from primary header
-        fnpol0 = fits.getval(fname, 'NPOLFILE')
+        fnpol0 = hdrs.getval('NPOLFILE')
         if fnpol0 == 'N/A':
-            utils.remove_distortion(fname, "NPOLFILE")
+            utils.remove_distortion(hdrs.source, "NPOLFILE")
+            hdrs.refresh()
             return False
         fnpol0 = fileutil.osfn(fnpol0)
         if not fileutil.findFile(fnpol0):
@@ -163,7 +177,7 @@ def applyNpolCorr(fname, unpolcorr):
             raise IOError("NPOLFILE {0} not found".format(fnpol0))
         try:
             # get NPOLEXT kw from first extension header
-            fnpol1 = fits.getval(fname, 'NPOLEXT', ext=1)
+            fnpol1 = hdrs.getval('NPOLEXT', ext=1)
             fnpol1 = fileutil.osfn(fnpol1)
             if fnpol1 and fileutil.findFile(fnpol1):
                 if fnpol0 != fnpol1:
@@ -187,7 +201,7 @@ def applyNpolCorr(fname, unpolcorr):
         applyNPOLCorr = False
         return applyNPOLCorr
 
-    if isOldStyleDGEO(fname, fnpol0):
+    if isOldStyleDGEO(hdrs, fnpol0):
             applyNPOLCorr = False
     return (applyNPOLCorr and unpolcorr)
 
@@ -195,8 +209,9 @@ def isOldStyleDGEO(fname, dgname):
     # checks if the file defined in a NPOLFILE kw is a full size
     # (old style) image
 
-    sci_hdr = fits.getheader(fname, ext=1)
-    dgeo_hdr = fits.getheader(dgname, ext=1)
+    sci_hdr = utils.header_snapshot(fname).getheader(ext=1)
+    dgeo_hdr = refcache.get_reference(dgname,
+                                      loader=utils.LookupTableIndex).hdulist[1].header
     sci_naxis1 = sci_hdr['NAXIS1']
     sci_naxis2 = sci_hdr['NAXIS2']
     dg_naxis1 = dgeo_hdr['NAXIS1']
@@ -210,12 +225,14 @@ def isOldStyleDGEO(fname, dgname):
         return False
 
 def applyD2ImCorr(fname, d2imcorr):
+    hdrs = utils.header_snapshot(fname)
     applyD2IMCorr = True
     try:
         # get D2IMFILE kw from primary header
-        fd2im0 = fits.getval(fname, 'D2IMFILE')
+        fd2im0 = hdrs.getval('D2IMFILE')
         if fd2im0 == 'N/A':
-            utils.remove_distortion(fname, "D2IMFILE")
+            utils.remove_distortion(hdrs.source, "D2IMFILE")
+            hdrs.refresh()
             return False
         fd2im0 = fileutil.osfn(fd2im0)
         if not fileutil.findFile(fd2im0):
@@ -226,7 +243,7 @@ def applyD2ImCorr(fname, d2imcorr):
             raise IOError("D2IMFILE {0} not found".format(fd2im0))
         try:
             # get D2IMEXT kw from first extension header
-            fd2imext = fits.getval(fname, 'D2IMEXT', ext=1)
+            fd2imext = hdrs.getval('D2IMEXT', ext=1)
             fd2imext = fileutil.osfn(fd2imext)
             if fd2imext and fileutil.findFile(fd2imext):
                 if fd2im0 != fd2imext:
@@ -131,6 +131,9 @@ class TDDCorr(object):
         skew_coeffs = hwcs.idcmodel.refpix['skew_coeffs']
         delta_date = rday - skew_coeffs['TDD_DATE']
 
+        # the coefficients may be shared with a cloned WCS (HSTWCS.clone)
+        hwcs.idcmodel.cx = hwcs.idcmodel.cx.copy()
+        hwcs.idcmodel.cy = hwcs.idcmodel.cy.copy()
         if skew_coeffs['TDD_CXB'] is not None:
             hwcs.idcmodel.cx[1,1] +=  skew_coeffs['TDD_CXB']*delta_date
         if skew_coeffs['TDD_CTB'] is not None:
@@ -158,6 +161,10 @@ class TDDCorr(object):
         delta_date = rday - skew_coeffs['TDD_DATE']
         print("DELTA_DATE: {0}   based on rday: {1}, TDD_DATE: {2}".format(delta_date,rday,skew_coeffs['TDD_DATE']))
 
+        # the coefficients may be shared with a cloned WCS (HSTWCS.clone)
+        hwcs.idcmodel.cx = hwcs.idcmodel.cx.copy()
+        hwcs.idcmodel.cy = hwcs.idcmodel.cy.copy()
+
         if cy_alpha is None:
             hwcs.idcmodel.cy[1,1] += cy_beta*delta_date
         else:
@@ -3,6 +3,7 @@ from __future__ import absolute_import, division # confidence high
 import numpy as np
 from astropy.io import fits
 from stsci.tools import fileutil
+from stwcs.distortion import refcache, tablestore
 
 from . import utils
 
@@ -30,12 +31,16 @@ class DET2IMCorr(object):
 
     """
 
-    def updateWCS(cls, fobj):
+    def updateWCS(cls, fobj, store=None):
         """
         Parameters
         ----------
         fobj: `astropy.io.fits.HDUList` object
                 Science file, for which a distortion correction in a NPOLFILE is available
+        store: `~stwcs.distortion.tablestore.TableStore` or None
+                If given, the lookup tables are added to the store and the
+                D2IMARR extensions only refer to them (see
+                `stwcs.distortion.tablestore.external_table_hdu`).
 
         """
         logger.info("\n\tStarting DET2IM: %s" %time.asctime())
@@ -45,7 +50,7 @@ class DET2IMCorr(object):
             logger.exception('\n\tInput must be a fits.HDUList object')
             raise
 
-        cls.applyDet2ImCorr(fobj)
+        cls.applyDet2ImCorr(fobj, store=store)
         d2imfile = fobj[0].header['D2IMFILE']
 
         new_kw = {'D2IMEXT': d2imfile}
@@ -53,7 +58,7 @@ class DET2IMCorr(object):
 
     updateWCS = classmethod(updateWCS)
 
-    def applyDet2ImCorr(cls, fobj):
+    def applyDet2ImCorr(cls, fobj, store=None):
         """
         For each science extension in a fits file object:
             - create a WCSDVARR extension
@@ -84,7 +89,8 @@ class DET2IMCorr(object):
                         hdu = cls.createD2ImHDU(header, d2imfile=d2imfile,
                                                 wdvarr_ver=d2im_num_ext,
                                                 d2im_extname=ename[0],
-                                                data=ename[1],ccdchip=ccdchip)
+                                                data=ename[1],ccdchip=ccdchip,
+                                                store=store)
                         if wcsdvarr_ind and d2im_num_ext in wcsdvarr_ind:
                             fobj[wcsdvarr_ind[d2im_num_ext]] = hdu
                         else:
@@ -158,32 +164,37 @@ class DET2IMCorr(object):
         """
         Get the data arrays from the reference D2I files
         Make sure 'CCDCHIP' in the npolfile matches "CCDCHIP' in the science file.
+
+        If a table store is set (`stwcs.distortion.tablestore`), the arrays
+        are read-only and shared with other processes using the store.
         """
-        xdata, ydata = (None, None)
-        d2im = fits.open(d2imfile)
-        for ext in d2im:
-            d2imextname  = ext.header.get('EXTNAME',"")
-            d2imccdchip  = ext.header.get('CCDCHIP',1)
-            if d2imextname == 'DX' and d2imccdchip == ccdchip:
-                xdata = ext.data.copy()
-                continue
-            elif d2imextname == 'DY' and d2imccdchip == ccdchip:
-                ydata = ext.data.copy()
-                continue
-            else:
-                continue
-        d2im.close()
+        xdata = tablestore.reference_table(d2imfile, 'DX', ccdchip, cls.readTable)
+        ydata = tablestore.reference_table(d2imfile, 'DY', ccdchip, cls.readTable)
         return xdata, ydata
     getData = classmethod(getData)
 
+    def readTable(cls, d2imfile, extname, ccdchip):
+        """
+        Read the array of extension extname for chip ccdchip from the
+        D2I reference file, None if there is no such extension.
+        """
+        index = refcache.get_reference(d2imfile, loader=utils.LookupTableIndex)
+        return index.data(extname, ccdchip)
+    readTable = classmethod(readTable)
+
     def createD2ImHDU(cls, sciheader, d2imfile=None, wdvarr_ver=1,
-                      d2im_extname=None,data = None, ccdchip=1):
+                      d2im_extname=None,data = None, ccdchip=1, store=None):
         """
         Creates an HDU to be added to the file object.
+
+        If store is given, the HDU has no data and refers to the table in
+        the store.
         """
         hdr = cls.createD2ImHdr(sciheader, d2imfile=d2imfile,
                                 wdvarr_ver=wdvarr_ver, d2im_extname=d2im_extname,
                                 ccdchip=ccdchip)
+        if store is not None:
+            return tablestore.external_table_hdu(hdr, data, store)
         hdu = fits.ImageHDU(header=hdr, data=data)
         return hdu
 
@@ -197,7 +208,7 @@ class DET2IMCorr(object):
         is such that a full size d2im table is created and then shifted or scaled
         if the science image is a subarray or binned image.
         """
-        d2im = fits.open(d2imfile)
+        d2im = refcache.get_reference(d2imfile, loader=utils.LookupTableIndex).hdulist
         d2im_phdr = d2im[0].header
         for ext in d2im:
             try:
@@ -211,7 +222,6 @@ class DET2IMCorr(object):
                 break
             else:
                 continue
-        d2im.close()
 
         naxis = d2im[1].header['NAXIS']
         ccdchip = d2imextname
@@ -1,15 +1,48 @@
 from __future__ import absolute_import, division # confidence high
 
 import logging, time
+import threading
+from collections import OrderedDict
 
 import numpy as np
 from astropy.io import fits
 
 from stsci.tools import fileutil
+from stwcs.distortion import refcache, tablestore, modelcache
 from . import utils
 
 logger = logging.getLogger('stwcs.updatewcs.npol')
 
+# Maximum number of transformed NPOL tables kept by
+# NPOLCorr.getTransformedData
+transform_cache_size = 16
+
+_transform_cache = OrderedDict()
+_transform_lock = threading.Lock()
+_transform_stats = {'hits': 0, 'misses': 0}
+
+
+def transform_cache_info():
+    """
+    Return the hit/miss counters and size of the transformed table cache.
+    """
+    with _transform_lock:
+        info = dict(_transform_stats)
+        info['size'] = len(_transform_cache)
+    info['maxsize'] = transform_cache_size
+    return info
+
+
+def clear_transform_cache():
+    """
+    Empty the transformed table cache and reset the counters.
+    """
+    with _transform_lock:
+        _transform_cache.clear()
+        _transform_stats['hits'] = 0
+        _transform_stats['misses'] = 0
+
+
 class NPOLCorr(object):
     """
     Defines a Lookup table prior distortion correction as per WCS paper IV.
@@ -35,12 +68,16 @@ class NPOLCorr(object):
     which are in the CD matrix when the SIP convention is used.
     """
 
-    def updateWCS(cls, fobj):
+    def updateWCS(cls, fobj, store=None):
         """
         Parameters
         ----------
         fobj : `astropy.io.fits.HDUList` object
             Science file, for which a distortion correction in a NPOLFILE is available
+        store : `~stwcs.distortion.tablestore.TableStore` or None
+            If given, the lookup tables are added to the store and the
+            WCSDVARR extensions only refer to them (see
+            `stwcs.distortion.tablestore.external_table_hdu`).
 
         """
         logger.info("\n\tStarting NPOL: %s" %time.asctime())
@@ -50,7 +87,7 @@ class NPOLCorr(object):
             logger.exception('\n\tInput must be a fits.HDUList object')
             raise
 
-        cls.applyNPOLCorr(fobj)
+        cls.applyNPOLCorr(fobj, store=store)
         nplfile = fobj[0].header['NPOLFILE']
 
         new_kw = {'NPOLEXT': nplfile}
@@ -58,7 +95,7 @@ class NPOLCorr(object):
 
     updateWCS = classmethod(updateWCS)
 
-    def applyNPOLCorr(cls, fobj):
+    def applyNPOLCorr(cls, fobj, store=None):
         """
         For each science extension in a fits file object:
             - create a WCSDVARR extension
@@ -79,11 +116,11 @@ class NPOLCorr(object):
                 header = ext.header
                 # get the data arrays from the reference file and transform
                 # them for use with SIP
-                dx,dy = cls.getData(nplfile, ccdchip)
                 idccoeffs = cls.getIDCCoeffs(header)
-
                 if idccoeffs is not None:
-                    dx, dy = cls.transformData(dx,dy, idccoeffs)
+                    dx, dy = cls.getTransformedData(nplfile, ccdchip, idccoeffs)
+                else:
+                    dx,dy = cls.getData(nplfile, ccdchip)
 
                 # Determine EXTVER for the WCSDVARR extension from the
                 # NPL file (EXTNAME, EXTVER) kw.
@@ -94,7 +131,8 @@ class NPOLCorr(object):
                     error_val = ename[2].max()
                     cls.addSciExtKw(header, wdvarr_ver=ename[1], npol_extname=ename[0], error_val=error_val)
                     hdu = cls.createNpolHDU(header, npolfile=nplfile, \
-                        wdvarr_ver=ename[1], npl_extname=ename[0], data=ename[2],ccdchip=ccdchip)
+                        wdvarr_ver=ename[1], npl_extname=ename[0], data=ename[2],ccdchip=ccdchip,
+                        store=store)
                     if wcsdvarr_ind:
                         fobj[wcsdvarr_ind[ename[1]]] = hdu
                     else:
@@ -169,34 +207,85 @@ class NPOLCorr(object):
         """
         Get the data arrays from the reference NPOL files
         Make sure 'CCDCHIP' in the npolfile matches "CCDCHIP' in the science file.
+
+        If a table store is set (`stwcs.distortion.tablestore`), the arrays
+        are read-only and shared with other processes using the store.
         """
-        npl = fits.open(nplfile)
-        for ext in npl:
-            nplextname  = ext.header.get('EXTNAME',"")
-            nplccdchip  = ext.header.get('CCDCHIP',1)
-            if nplextname == 'DX' and nplccdchip == ccdchip:
-                xdata = ext.data.copy()
-                continue
-            elif nplextname == 'DY' and nplccdchip == ccdchip:
-                ydata = ext.data.copy()
-                continue
-            else:
-                continue
-        npl.close()
+        xdata = tablestore.reference_table(nplfile, 'DX', ccdchip, cls.readTable)
+        ydata = tablestore.reference_table(nplfile, 'DY', ccdchip, cls.readTable)
         return xdata, ydata
     getData = classmethod(getData)
 
-    def transformData(cls, dx, dy, coeffs):
+    def readTable(cls, nplfile, extname, ccdchip):
+        """
+        Read the array of extension extname for chip ccdchip from the
+        NPOL reference file, None if there is no such extension.
+        """
+        index = refcache.get_reference(nplfile, loader=utils.LookupTableIndex)
+        return index.data(extname, ccdchip)
+    readTable = classmethod(readTable)
+
+    def transformData(cls, dx, dy, coeffs, out=None):
         """
         Transform the NPOL data arrays for use with SIP
+
+        Parameters
+        ----------
+        dx, dy : ndarray
+            NPOL lookup tables
+        coeffs : ndarray
+            2x2 matrix returned by `getIDCCoeffs`
+        out : tuple of two float32 arrays, optional
+            Arrays of the shape of dx in which the result is stored.
         """
-        ndx, ndy = np.dot(coeffs, [dx.ravel(), dy.ravel()]).astype(np.float32)
-        ndx.shape = dx.shape
-        ndy.shape=dy.shape
+        if out is None:
+            out = (np.empty(dx.shape, dtype=np.float32),
+                   np.empty(dy.shape, dtype=np.float32))
+        ndx, ndy = out
+        # ndx = c00*dx + c01*dy, ndy = c10*dx + c11*dy, computed in place
+        # with a single scratch array instead of stacking the inputs
+        scratch = np.empty(dx.shape, dtype=np.float32)
+        np.multiply(dx, coeffs[0, 0], out=ndx)
+        np.multiply(dy, coeffs[0, 1], out=scratch)
+        ndx += scratch
+        np.multiply(dx, coeffs[1, 0], out=ndy)
+        np.multiply(dy, coeffs[1, 1], out=scratch)
+        ndy += scratch
         return ndx, ndy
 
     transformData = classmethod(transformData)
 
+    def getTransformedData(cls, nplfile, ccdchip, coeffs):
+        """
+        Return the NPOL arrays for ccdchip transformed with coeffs.
+
+        Results are memoized per reference file, chip and coefficients,
+        so that exposures sharing an NPOLFILE and IDCTAB are transformed
+        once. The least recently used results are evicted when more than
+        `transform_cache_size` are kept. The returned arrays are shared
+        and read-only.
+        """
+        coeffs = np.asarray(coeffs)
+        key = (modelcache.file_signature(nplfile), ccdchip, coeffs.dtype.str,
+               coeffs.tobytes())
+        with _transform_lock:
+            try:
+                result = _transform_cache.pop(key)
+            except KeyError:
+                _transform_stats['misses'] += 1
+                dx, dy = cls.getData(nplfile, ccdchip)
+                result = cls.transformData(dx, dy, coeffs)
+                for arr in result:
+                    arr.flags.writeable = False
+            else:
+                _transform_stats['hits'] += 1
+            _transform_cache[key] = result
+            while len(_transform_cache) > max(transform_cache_size, 0):
+                _transform_cache.popitem(last=False)
+        return result
+
+    getTransformedData = classmethod(getTransformedData)
+
     def getIDCCoeffs(cls, header):
         """
         Return a matrix of the scaled first order IDC coefficients.
@@ -221,11 +310,17 @@ class NPOLCorr(object):
 
     getIDCCoeffs = classmethod(getIDCCoeffs)
 
-    def createNpolHDU(cls, sciheader, npolfile=None, wdvarr_ver=1, npl_extname=None,data = None, ccdchip=1):
+    def createNpolHDU(cls, sciheader, npolfile=None, wdvarr_ver=1, npl_extname=None,data = None, ccdchip=1,
+                      store=None):
         """
         Creates an HDU to be added to the file object.
+
+        If store is given, the HDU has no data and refers to the table in
+        the store.
         """
         hdr = cls.createNpolHdr(sciheader, npolfile=npolfile, wdvarr_ver=wdvarr_ver, npl_extname=npl_extname, ccdchip=ccdchip)
+        if store is not None:
+            return tablestore.external_table_hdu(hdr, data, store)
         hdu = fits.ImageHDU(header=hdr, data=data)
         return hdu
 
@@ -239,7 +334,7 @@ class NPOLCorr(object):
         i ssuch that a full size npol table is created and then shifted or scaled
         if the science image is a subarray or binned image.
         """
-        npl = fits.open(npolfile)
+        npl = refcache.get_reference(npolfile, loader=utils.LookupTableIndex).hdulist
         npol_phdr = npl[0].header
         for ext in npl:
             try:
@@ -253,7 +348,6 @@ class NPOLCorr(object):
                 break
             else:
                 continue
-        npl.close()
 
         naxis = npl[1].header['NAXIS']
         ccdchip = nplextname #npol_header['CCDCHIP']
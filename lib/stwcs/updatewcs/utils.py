@@ -1,5 +1,8 @@
 from __future__ import division # confidence high
 import os
+import time
+import traceback
+import multiprocessing
 from astropy.io import fits
 from stsci.tools import fileutil
 
@@ -7,6 +10,269 @@ import logging
 logger = logging.getLogger("stwcs.updatewcs.utils")
 
 
+class HeaderSnapshot(object):
+    """
+    Headers of a science file read in a single pass.
+
+    The decision logic in `apply_corrections` and `updatewcs` needs a
+    handful of keywords from the primary and extension headers. A snapshot
+    is built from one open of the file and shared by all of them instead of
+    each function opening the file again.
+
+    Parameters
+    ----------
+    fobj : str or `astropy.io.fits.HDUList`
+        Science file name or file object.
+
+    Notes
+    -----
+    The snapshot is not updated when the file is modified on disk,
+    `refresh` must be called after such changes.
+
+    A snapshot of an `astropy.io.fits.HDUList` keeps a reference to it
+    (``hdulist``); functions which modify the science file are passed
+    `source`, so that an in-memory file is modified in place instead of
+    being reopened from disk.
+    """
+    def __init__(self, fobj):
+        if isinstance(fobj, fits.HDUList):
+            self.hdulist = fobj
+            self.filename = fobj.filename()
+            self._read(fobj)
+        else:
+            self.hdulist = None
+            self.filename = fobj
+            self.refresh()
+
+    @property
+    def source(self):
+        """
+        The file object the snapshot was made from, or the file name.
+        """
+        if self.hdulist is not None:
+            return self.hdulist
+        return self.filename
+
+    def refresh(self):
+        """
+        Read the headers from the file again.
+        """
+        if self.hdulist is not None:
+            self._read(self.hdulist)
+            return
+        f = fits.open(self.filename)
+        try:
+            self._read(f)
+        finally:
+            f.close()
+
+    def _read(self, fobj):
+        self.headers = [hdu.header for hdu in fobj]
+        self._extmap = {}
+        for i, hdr in enumerate(self.headers):
+            if 'EXTNAME' in hdr:
+                extn = (hdr['EXTNAME'].upper(), hdr.get('EXTVER', 1))
+                self._extmap.setdefault(extn, i)
+
+    def __len__(self):
+        return len(self.headers)
+
+    def index(self, ext):
+        """
+        Return the index of an extension given as an integer,
+        an EXTNAME or an (EXTNAME, EXTVER) tuple.
+        """
+        if isinstance(ext, tuple):
+            return self._extmap[(ext[0].upper(), ext[1])]
+        elif isinstance(ext, str):
+            return self._extmap[(ext.upper(), 1)]
+        return ext
+
+    def getheader(self, ext=0):
+        return self.headers[self.index(ext)]
+
+    def getval(self, keyword, ext=0):
+        """
+        Return the value of a keyword, raises KeyError (like
+        `astropy.io.fits.getval`) if the keyword is missing.
+        """
+        return self.getheader(ext)[keyword]
+
+
+def header_snapshot(fobj):
+    """
+    Return a `HeaderSnapshot` for fobj, or fobj itself if it already is one.
+    """
+    if isinstance(fobj, HeaderSnapshot):
+        return fobj
+    return HeaderSnapshot(fobj)
+
+
+class LookupTableIndex(object):
+    """
+    An index of the extensions of an NPOL or D2IM reference file.
+
+    The file is opened once, with memory mapping, and only its headers are
+    read. Extensions are indexed by (EXTNAME, CCDCHIP), so finding the table
+    of a chip is a dictionary lookup, and the data of an extension is read
+    from the file when it is first requested. Instances are cached by
+    `stwcs.distortion.refcache`, one per reference file.
+
+    Parameters
+    ----------
+    filename : str
+        Name of the reference file.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.hdulist = fits.open(filename, memmap=True)
+        self._index = {}
+        for i, hdu in enumerate(self.hdulist):
+            key = (hdu.header.get('EXTNAME', ""), hdu.header.get('CCDCHIP', 1))
+            # the last matching extension is used, as in a sequential search
+            self._index[key] = i
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def data(self, extname, ccdchip):
+        """
+        Return the array of extension extname for chip ccdchip, None if
+        the file has no such extension.
+
+        The array is memory mapped and read-only; it is shared by all
+        users of the index.
+        """
+        i = self._index.get((extname, ccdchip))
+        if i is None:
+            return None
+        data = self.hdulist[i].data
+        data.flags.writeable = False
+        return data
+
+
+class RecordCollector(logging.Handler):
+    """
+    Logging handler which keeps the records emitted while a task runs
+    in a worker process, so that they can be passed back to the main process.
+    """
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        # Format the message here so that the record can be pickled
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        self.records.append(record)
+
+
+def _init_pool_worker(logname, level, initializer, initargs):
+    """
+    Pool initializer: records are collected per task and handled by the
+    main process, workers do not write to the log files themselves.
+    """
+    log = logging.getLogger(logname)
+    for handler in log.handlers[:]:
+        log.removeHandler(handler)
+    log.setLevel(level)
+    log.propagate = False
+    if initializer is not None:
+        initializer(*initargs)
+
+
+def _run_task(args):
+    """
+    Run one task of `run_tasks`, in this process or in a worker process.
+
+    Returns the index of the task, its result dictionary and, in a worker
+    process, the log records emitted by the task.
+    """
+    i, func, task, logname, errmsg, collect = args
+    log = logging.getLogger(logname)
+    if collect:
+        collector = RecordCollector()
+        log.addHandler(collector)
+    result = {'status': 'OK', 'error': None}
+    t0 = time.time()
+    try:
+        result.update(func(*task) or {})
+    except Exception:
+        result['status'] = 'FAILED'
+        result['error'] = traceback.format_exc()
+        log.error(errmsg + ":\n%s", task[0], result['error'])
+    finally:
+        if collect:
+            log.removeHandler(collector)
+    result['time'] = time.time() - t0
+    return i, result, collector.records if collect else []
+
+
+def run_tasks(func, tasks, logname, errmsg, nprocs=1, initializer=None,
+              initargs=()):
+    """
+    Run ``func(*task)`` for each task, in a pool of worker processes when
+    nprocs is not 1.
+
+    Each call is timed and its exceptions are caught, so that a failure
+    affects only its task. In a worker process the records emitted to the
+    logger logname (and its children) are collected and handled by the main
+    process as one block per task, in order of completion.
+
+    Parameters
+    ----------
+    func : callable
+        Module level function run for each task; it may return a dictionary
+        which is added to the result of the task.
+    tasks : list of tuples
+        Arguments of each call; the first one (usually a file name) is
+        used in the error message.
+    logname : str
+        Name of the logger whose records are passed back to this process;
+        its level is set in the worker processes.
+    errmsg : str
+        Message logged on failure, with a ``%s`` for the first argument.
+    nprocs : int or None
+        Number of worker processes, None to use all available CPUs. If 1,
+        tasks are run in this process.
+    initializer : callable or None
+        Function run with initargs in each worker process.
+
+    Returns
+    -------
+    results : list of dictionaries
+        One per task, in task order, with keys 'status' ('OK' unless set by
+        func, or 'FAILED'), 'error' (the traceback of the failure or None),
+        'time' (run time in seconds) and those returned by func.
+    """
+    results = [None] * len(tasks)
+    if nprocs is not None and nprocs <= 1:
+        for i, task in enumerate(tasks):
+            # records are handled by the logger as they are emitted
+            results[i] = _run_task((i, func, task, logname, errmsg, False))[1]
+        return results
+
+    level = logging.getLogger(logname).getEffectiveLevel()
+    args = [(i, func, task, logname, errmsg, True) for i, task in enumerate(tasks)]
+    pool = multiprocessing.Pool(processes=nprocs, initializer=_init_pool_worker,
+                                initargs=(logname, level, initializer, initargs))
+    try:
+        for i, result, records in pool.imap_unordered(_run_task, args):
+            for record in records:
+                logging.getLogger(record.name).handle(record)
+            results[i] = result
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return results
+
+
 def diff_angles(a,b):
     """
     Perform angle subtraction a-b taking into account
@@ -149,6 +415,9 @@ def build_sipname(fobj, fname=None, sipname=None):
         try:
             fname = fobj.filename()
         except:
+            fname = None
+        # in-memory files have no name
+        if not fname:
             fname = " "
     if not sipname:
         try:
@@ -238,7 +507,13 @@ def build_d2imname(fobj, d2imfile=None):
 
 
 def remove_distortion(fname, dist_keyword):
-    logger.info("Removing distortion {0} from file {0}".format(dist_keyword, fname))
+    """
+    Remove a lookup table distortion from a science file.
+
+    fname may be a file name, or an `astropy.io.fits.HDUList` which is
+    modified in place.
+    """
+    logger.info("Removing distortion {0} from file {1}".format(dist_keyword, fname))
     from ..wcsutil import altwcs
     if dist_keyword == "NPOLFILE":
         extname = "WCSDVARR"
@@ -249,16 +524,18 @@ def remove_distortion(fname, dist_keyword):
     else:
         raise AttributeError("Unrecognized distortion keyword "
                              "{0} when attempting to remove distortion".format(dist_keyword))
-    ext_mapping = altwcs.mapFitsExt2HDUListInd(fname, "SCI").values()
-    f = fits.open(fname, mode="update")
+    if isinstance(fname, str):
+        f = fits.open(fname, mode="update")
+    else:
+        f = fname
+    ext_mapping = altwcs.mapFitsExt2HDUListInd(f, "SCI").values()
     for hdu in ext_mapping:
         for kw in keywords:
             try:
                 del f[hdu].header[kw]
-            except AttributeError:
+            except KeyError:
                 pass
-    ext_mapping = altwcs.mapFitsExt2HDUListInd(fname, extname).values()
-    ext_mapping.sort()
+    ext_mapping = sorted(altwcs.mapFitsExt2HDUListInd(f, extname).values())
     for hdu in ext_mapping[::-1]:
         del f[hdu]
-    f.close()
+    altwcs.closefobj(fname, f)
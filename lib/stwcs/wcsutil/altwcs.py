@@ -6,6 +6,7 @@ import numpy as np
 from astropy import wcs as pywcs
 from astropy.io import fits
 from stsci.tools import fileutil as fu
+from stwcs.distortion import tablestore
 
 altwcskw = ['WCSAXES', 'CRVAL', 'CRPIX', 'PC', 'CDELT', 'CD', 'CTYPE', 'CUNIT',
             'PV', 'PS']
@@ -481,7 +482,7 @@ def readAltWCS(fobj, ext, wcskey=' ',verbose=False):
 
     hdr = _getheader(fobj,ext)
     try:
-        nwcs = pywcs.WCS(hdr, fobj=fobj, key=wcskey)
+        nwcs = pywcs.WCS(hdr, fobj=tablestore.resolve_tables(fobj), key=wcskey)
     except KeyError:
         if verbose:
             print('readAltWCS: Could not read WCS with key %s' %wcskey)
@@ -0,0 +1,301 @@
+"""
+A local repository of headerlets.
+
+Headerlets are otherwise kept as standalone ``_hdr.fits`` files or as
+HDRLET extensions of science files, and finding one means opening the
+files. A `HeaderletStore` is a single SQLite database which holds the
+headerlets and a table of their primary header keywords (`INDEX_COLS`),
+so that queries such as "the latest headerlet of rootname X with
+distortion model Y" are answered from the index without reading any
+headerlet.
+
+A headerlet is stored as its FITS file, zlib compressed, and is returned
+as a `~stwcs.wcsutil.headerlet.Headerlet`. HDRNAME is unique per DESTIM,
+as it is in a science file.
+
+Examples
+--------
+>>> from stwcs.wcsutil.hdrletstore import HeaderletStore
+>>> with HeaderletStore('headerlets.db') as store:
+...     store.import_files('*_hdr.fits')
+...     hlet = store.latest('j94f05bgq', distname='j94f05bgq_idc-npl-d2i')
+...     store.export('hlets', destim='j94f05bgq')
+
+"""
+from __future__ import absolute_import, division, print_function
+
+import io
+import os
+import zlib
+import sqlite3
+
+from astropy.io import fits
+from stsci.tools import fileutil as fu
+
+from .headerlet import Headerlet, _expand_input
+
+import logging
+logger = logging.getLogger('stwcs.wcsutil.hdrletstore')
+
+__all__ = ['HeaderletStore', 'INDEX_COLS']
+
+# Primary header keywords of a headerlet kept as index columns
+INDEX_COLS = ['DESTIM', 'HDRNAME', 'WCSNAME', 'DISTNAME', 'SIPNAME',
+              'NPOLFILE', 'D2IMFILE', 'DATE', 'NMATCH', 'CATALOG']
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS headerlets (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    destim TEXT NOT NULL,
+    hdrname TEXT NOT NULL,
+    wcsname TEXT,
+    distname TEXT,
+    sipname TEXT,
+    npolfile TEXT,
+    d2imfile TEXT,
+    date TEXT,
+    nmatch INTEGER,
+    catalog TEXT,
+    payload BLOB NOT NULL,
+    UNIQUE (destim, hdrname)
+);
+CREATE INDEX IF NOT EXISTS headerlets_dist
+    ON headerlets (destim, distname, date);
+CREATE INDEX IF NOT EXISTS headerlets_wcsname
+    ON headerlets (destim, wcsname);
+CREATE INDEX IF NOT EXISTS headerlets_date ON headerlets (date);
+"""
+
+
+def _index_values(header):
+    """
+    Return the index column values of a headerlet primary header.
+    """
+    values = []
+    for kw in INDEX_COLS:
+        val = header.get(kw)
+        if isinstance(val, str):
+            val = val.strip()
+        values.append(val)
+    return values
+
+
+class HeaderletStore(object):
+    """
+    A SQLite database of headerlets indexed by their primary header keywords.
+
+    Parameters
+    ----------
+    path : str
+        Name of the database file, created if it does not exist.
+    timeout : float
+        Seconds to wait for a lock held by another process writing the
+        same database.
+    """
+    def __init__(self, path, timeout=30.):
+        self.path = os.path.abspath(fu.osfn(path))
+        self._conn = sqlite3.connect(self.path, timeout=timeout)
+        self._conn.row_factory = sqlite3.Row
+        with self._conn:
+            self._conn.executescript(_SCHEMA)
+
+    def __repr__(self):
+        return "<%s %s>" % (self.__class__.__name__, self.path)
+
+    def __len__(self):
+        return self._conn.execute("SELECT COUNT(*) FROM headerlets").fetchone()[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """
+        Close the database.
+        """
+        self._conn.close()
+
+    def add(self, hdrlet, replace=False):
+        """
+        Add a headerlet to the store and return its id.
+
+        Parameters
+        ----------
+        hdrlet : `~stwcs.wcsutil.headerlet.Headerlet`, HDUList or str
+            The headerlet or the name of a headerlet file. A ValueError
+            is raised if it has no DESTIM or HDRNAME.
+        replace : bool
+            If True, a headerlet with the same DESTIM and HDRNAME is
+            replaced, otherwise a ValueError is raised.
+        """
+        ids = self._add([hdrlet], replace)
+        self._conn.commit()
+        return ids[0]
+
+    def import_files(self, filenames, replace=False):
+        """
+        Add headerlet files to the store in one transaction.
+
+        Parameters
+        ----------
+        filenames : str or list of str
+            File names: a list, a string with wild cards, an @-file or a
+            directory (all FITS files in it).
+        replace : bool
+            See `add`.
+
+        Returns
+        -------
+        ids : list of int
+            The ids of the headerlets, in input order. FITS files of a
+            directory which are not headerlets (no DESTIM or HDRNAME) are
+            skipped; such files given by name raise a ValueError.
+        """
+        skip_invalid = (isinstance(filenames, str) and
+                        os.path.isdir(fu.osfn(filenames)))
+        filenames = _expand_input(filenames)
+        try:
+            ids = self._add(filenames, replace, skip_invalid)
+        except:
+            self._conn.rollback()
+            raise
+        self._conn.commit()
+        logger.info("Imported %d headerlets into %s" % (len(ids), self.path))
+        return ids
+
+    def _add(self, hdrlets, replace, skip_invalid=False):
+        verb = 'INSERT OR REPLACE' if replace else 'INSERT'
+        sql = "%s INTO headerlets (%s, payload) VALUES (%s)" % (
+            verb, ', '.join(INDEX_COLS), ', '.join(['?'] * (len(INDEX_COLS) + 1)))
+        ids = []
+        for h in hdrlets:
+            if isinstance(h, str):
+                with open(fu.osfn(h), 'rb') as f:
+                    data = f.read()
+                header = fits.getheader(fu.osfn(h))
+            else:
+                fileobj = io.BytesIO()
+                h.writeto(fileobj)
+                data = fileobj.getvalue()
+                header = h[0].header
+            values = _index_values(header)
+            if not values[0] or not values[1]:
+                name = h if isinstance(h, str) else 'HDUList'
+                if skip_invalid:
+                    logger.info("Skipping %s: not a headerlet (no DESTIM or "
+                                "HDRNAME)" % name)
+                    continue
+                raise ValueError("%s is not a headerlet: DESTIM and HDRNAME "
+                                 "are required" % name)
+            try:
+                cursor = self._conn.execute(sql, values +
+                                            [sqlite3.Binary(zlib.compress(data))])
+            except sqlite3.IntegrityError:
+                raise ValueError("Store %s already has a headerlet with "
+                                 "DESTIM=%s and HDRNAME=%s" %
+                                 (self.path, values[0], values[1]))
+            ids.append(cursor.lastrowid)
+        return ids
+
+    def _where(self, criteria):
+        clauses = []
+        values = []
+        for kw in sorted(criteria):
+            if kw.upper() not in INDEX_COLS:
+                raise KeyError("%s is not an index column of the headerlet "
+                               "store, use one of %s" % (kw, INDEX_COLS))
+            clauses.append("%s = ?" % kw.lower())
+            values.append(criteria[kw])
+        if clauses:
+            return " WHERE " + " AND ".join(clauses), values
+        return "", values
+
+    def query(self, **criteria):
+        """
+        Return the index rows of the headerlets matching all criteria.
+
+        Criteria are index columns (`INDEX_COLS`, case insensitive) and
+        the values they must be equal to. The rows are dictionaries with
+        an 'ID' key and a key for each index column, sorted by DATE, newest
+        first; headerlets with the same DATE are in reverse order of
+        addition.
+
+        Examples
+        --------
+        >>> store.query(destim='j94f05bgq', wcsname='IDC_v5')
+        """
+        where, values = self._where(criteria)
+        sql = "SELECT id, %s FROM headerlets%s ORDER BY date DESC, id DESC" % (
+            ', '.join(INDEX_COLS), where)
+        rows = []
+        for row in self._conn.execute(sql, values):
+            rows.append(dict(zip(['ID'] + INDEX_COLS, tuple(row))))
+        return rows
+
+    def get(self, id):
+        """
+        Return the headerlet with this id.
+        """
+        row = self._conn.execute("SELECT payload FROM headerlets WHERE id = ?",
+                                 (id,)).fetchone()
+        if row is None:
+            raise KeyError("No headerlet with id %s in store %s" % (id, self.path))
+        return Headerlet.fromstring(zlib.decompress(bytes(row[0])))
+
+    def latest(self, destim, **criteria):
+        """
+        Return the headerlet of destim with the latest DATE which matches
+        criteria (see `query`), or None if there is none.
+
+        Examples
+        --------
+        >>> hlet = store.latest('j94f05bgq', distname='j94f05bgq_idc-npl-d2i')
+        >>> hlet.apply_as_primary('j94f05bgq_flt.fits')
+        """
+        criteria['destim'] = destim
+        where, values = self._where(criteria)
+        row = self._conn.execute("SELECT id FROM headerlets%s "
+                                 "ORDER BY date DESC, id DESC LIMIT 1" % where,
+                                 values).fetchone()
+        if row is None:
+            return None
+        return self.get(row[0])
+
+    def remove(self, **criteria):
+        """
+        Remove the headerlets matching criteria (see `query`) and return
+        their number. At least one criterion is required.
+        """
+        if not criteria:
+            raise ValueError("remove() requires at least one criterion")
+        where, values = self._where(criteria)
+        with self._conn:
+            cursor = self._conn.execute("DELETE FROM headerlets" + where, values)
+        return cursor.rowcount
+
+    def export(self, directory, clobber=False, **criteria):
+        """
+        Write the headerlets matching criteria (see `query`) to files.
+
+        The files are named ``<DESTIM>_<HDRNAME>_hdr.fits``.
+
+        Returns
+        -------
+        filenames : list of str
+            The files written.
+        """
+        directory = fu.osfn(directory)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        filenames = []
+        for row in self.query(**criteria):
+            hlet = self.get(row['ID'])
+            fname = os.path.join(directory, '%s_%s_hdr.fits' %
+                                 (row['DESTIM'], row['HDRNAME']))
+            hlet.tofile(fname, clobber=clobber)
+            hlet.close()
+            filenames.append(fname)
+        logger.info("Exported %d headerlets to %s" % (len(filenames), directory))
+        return filenames
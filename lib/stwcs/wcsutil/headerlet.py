@@ -11,13 +11,18 @@ when only the WCS information has been updated.
 """
 
 from __future__ import absolute_import, division, print_function
+import io
 import os
 import sys
+import gzip
 import functools
 import logging
 import textwrap
 import copy
+import glob
 import time
+import traceback
+import multiprocessing
 
 import numpy as np
 from astropy.io import fits
@@ -30,6 +35,7 @@ from stsci.tools import fileutil as fu
 from stsci.tools import parseinput
 
 from stwcs.updatewcs import utils
+from stwcs.distortion import tablestore
 from . import altwcs
 from . import wcscorr
 from .hstwcs import HSTWCS
@@ -191,7 +197,9 @@ def get_headerlet_kw_names(fobj, kw='HDRNAME'):
 
     hdrnames = []
     for ext in fobj:
-        if isinstance(ext, fits.hdu.base.NonstandardExtHDU):
+        if isinstance(ext, HeaderletHDU):
+            hdrnames.append(ext.metadata(kw))
+        elif isinstance(ext, fits.hdu.base.NonstandardExtHDU):
             hdrnames.append(ext.header[kw])
 
     if open_fobj:
@@ -373,6 +381,23 @@ def update_ref_files(source, dest):
             phdukw[key] = False
     return phdukw
 
+def _build_summary(summary_cols, getval):
+    """
+    Returns the summary dictionary of one headerlet, getval(kw, default)
+    returns the value of a headerlet keyword.
+    """
+    # Initialize summary dict based on requested columns
+    summary = {}
+    for kw in summary_cols:
+        summary[kw] = copy.deepcopy(COLUMN_DICT)
+
+    # Populate the summary with headerlet values
+    for kw in summary_cols:
+        val = getval(kw, 'INDEF')
+        summary[kw]['vals'].append(val)
+        summary[kw]['width'].append(max(len(val), len(kw)))
+    return summary
+
 def print_summary(summary_cols, summary_dict, pad=2, maxwidth=None, idcol=None,
                     output=None, clobber=True, quiet=False ):
     """
@@ -802,16 +827,7 @@ def write_headerlet(filename, hdrname, output=None, sciext='SCI',
             logger.info('Closing image in write_headerlet()...')
             fobj.close()
 
-        frootname = fu.buildNewRootname(fname)
-
-        if output is None:
-            # Generate default filename for headerlet FITS file
-            outname = '{0}_hlet.fits'.format(frootname)
-        else:
-            outname = output
-
-        if not outname.endswith('.fits'):
-            outname = '{0}_{1}_hlet.fits'.format(frootname,outname)
+        outname = _headerlet_output_name(fname, output)
 
         # If user specifies an output filename for headerlet, write it out
         hdrletobj.tofile(outname, clobber=clobber)
@@ -819,6 +835,120 @@ def write_headerlet(filename, hdrname, output=None, sciext='SCI',
 
         del hdrletobj
 
+def _headerlet_output_name(fname, output):
+    """
+    Returns the name of the headerlet file written by `write_headerlet`
+    for science file fname and the output parameter.
+    """
+    frootname = fu.buildNewRootname(fname)
+
+    if output is None:
+        # Generate default filename for headerlet FITS file
+        outname = '{0}_hlet.fits'.format(frootname)
+    else:
+        outname = output
+
+    if not outname.endswith('.fits'):
+        outname = '{0}_{1}_hlet.fits'.format(frootname,outname)
+    return outname
+
+def _write_from_file(fname, outname, kwargs):
+    """
+    Run `write_headerlet` for one science file; used by `utils.run_tasks`.
+    """
+    write_headerlet(fname, output=outname, logging=False, **kwargs)
+    return {'size': os.path.getsize(outname)}
+
+@with_logging
+def write_headerlets(filenames, hdrname=None, output=None, sciext='SCI',
+                     wcsname=None, wcskey=None, destim=None,
+                     sipname=None, npolfile=None, d2imfile=None,
+                     author=None, descrip=None, history=None,
+                     nmatch=None, catalog=None,
+                     attach=True, clobber=False, nprocs=1,
+                     logging=False, logmode='w'):
+    """
+    Save a WCS of many science files as headerlet files.
+
+    This runs `write_headerlet` for each file, in a pool of worker processes
+    when nprocs is not 1. Each file is read and updated (when attach is True)
+    by one process only, and each process writes its own headerlet files.
+    A headerlet is built from the WCS keywords and distortion extensions of
+    its science file only, no reference file is read, so the workers have
+    nothing to share.
+
+    Parameters
+    ----------
+    filenames: string or list of strings
+        Science files: a list, a string with wild cards, an @-file or a
+        directory (all FITS files in it)
+    output: string or None
+        Suffix of the headerlet file names, see `write_headerlet`. A full
+        file name ending in '.fits' is not allowed since all files would
+        write it.
+    nprocs: int
+        Number of worker processes, None to use all available CPUs.
+        If 1 (default), files are processed in this process.
+    logging: boolean
+        enable file logging
+    logmode: 'w' or 'a'
+        log file open mode
+
+    All other parameters are passed to `write_headerlet` for every file.
+
+    Returns
+    -------
+    report: list of dictionaries
+        One dictionary per science file, in input order, with keys
+        'filename', 'output' (the headerlet file), 'status' ('OK' or
+        'FAILED'), 'error' (the traceback of the failure or None), 'time'
+        (processing time in seconds) and 'size' (bytes written)
+    stats: dictionary
+        Throughput statistics: 'files', 'failed', 'nprocs', 'elapsed'
+        (wall clock seconds), 'cpu_time' (sum of the processing times),
+        'files_per_sec', 'bytes' and 'mb_per_sec' (headerlet data written)
+    """
+    t0 = time.time()
+    filenames = _expand_input(filenames)
+    outnames = [_headerlet_output_name(f, output) for f in filenames]
+    if len(set(outnames)) < len(outnames):
+        dups = sorted(set([o for o in outnames if outnames.count(o) > 1]))
+        raise ValueError("More than one science file would be written to "
+                         "headerlet file(s) %s" % dups)
+    kwargs = dict(hdrname=hdrname, sciext=sciext, wcsname=wcsname,
+                  wcskey=wcskey, destim=destim, sipname=sipname,
+                  npolfile=npolfile, d2imfile=d2imfile, author=author,
+                  descrip=descrip, history=history, nmatch=nmatch,
+                  catalog=catalog, attach=attach, clobber=clobber)
+    tasks = [(f, o, kwargs) for f, o in zip(filenames, outnames)]
+
+    results = utils.run_tasks(_write_from_file, tasks, logger.name,
+                              "Failed to write a headerlet from %s",
+                              nprocs=nprocs)
+    nprocs = nprocs or multiprocessing.cpu_count()
+
+    report = []
+    for fname, outname, result in zip(filenames, outnames, results):
+        result.update({'filename': fname, 'output': outname})
+        result.setdefault('size', 0)
+        report.append(result)
+    failed = [r['filename'] for r in report if r['status'] == 'FAILED']
+    elapsed = time.time() - t0
+    nbytes = sum([r['size'] for r in report])
+    stats = {'files': len(report), 'failed': len(failed), 'nprocs': nprocs,
+             'elapsed': elapsed,
+             'cpu_time': sum([r['time'] for r in report]),
+             'files_per_sec': len(report) / elapsed if elapsed else 0.,
+             'bytes': nbytes,
+             'mb_per_sec': nbytes / 2.**20 / elapsed if elapsed else 0.}
+    logger.info("Wrote %d headerlets in %.2f s with %d processes: "
+                "%.1f files/s, %.2f MB/s, %d files failed" %
+                (stats['files'] - stats['failed'], elapsed, nprocs,
+                 stats['files_per_sec'], stats['mb_per_sec'], len(failed)))
+    if failed:
+        logger.critical("Headerlets could not be written from: %s" % failed)
+    return report, stats
+
 @with_logging
 def create_headerlet(filename, sciext='SCI', hdrname=None, destim=None,
                      wcskey=" ", wcsname=None,
@@ -1198,6 +1328,186 @@ def apply_headerlet_as_alternate(filename, hdrlet, attach=True, wcskey=None,
                             wcsname=wcsname, wcskey=wcskey)
 
 
+def _expand_input(input):
+    """
+    Returns the list of file names in input: a list, a string with wild
+    cards or an @-file (see `stsci.tools.parseinput`), or a directory, from
+    which all FITS files are taken.
+    """
+    if isinstance(input, str) and os.path.isdir(fu.osfn(input)):
+        return sorted(glob.glob(os.path.join(fu.osfn(input), '*.fits')))
+    if isinstance(input, list):
+        files = []
+        for f in input:
+            files.extend(_expand_input(f))
+        return files
+    return parseinput.parseinput(input)[0]
+
+def match_headerlets(hdrlets, filenames):
+    """
+    Matches headerlet files to science files by DESTIM and ROOTNAME.
+
+    Only the primary headers are read. A science file without ROOTNAME
+    is matched by its file name without the '.fits' extension. A science
+    file listed more than once (by the same or another path) is kept only
+    once, so that it is never updated by two processes.
+
+    Parameters
+    ----------
+    hdrlets: list of strings
+        Headerlet file names
+    filenames: list of strings
+        Science file names
+
+    Returns
+    -------
+    matches: list of tuples
+        (science file, list of headerlets) for each readable science file,
+        in input order; the headerlets are in input order too
+    unmatched: list of strings
+        Headerlets whose DESTIM is not the ROOTNAME of any science file
+    invalid: list of tuples
+        (file name, traceback) for each science file or headerlet whose
+        primary header could not be read, or headerlet without DESTIM
+    """
+    seen = set()
+    by_root = {}
+    scifiles = []
+    invalid = []
+    for fname in filenames:
+        path = os.path.abspath(fu.osfn(fname))
+        if path in seen:
+            continue
+        seen.add(path)
+        try:
+            hdr = fits.getheader(fname)
+        except Exception:
+            invalid.append((fname, traceback.format_exc()))
+            continue
+        root = hdr.get('ROOTNAME', os.path.basename(fname).split('.fits')[0])
+        by_root.setdefault(root.strip(), []).append(fname)
+        scifiles.append(fname)
+    hdrlets_of = dict([(fname, []) for fname in scifiles])
+    unmatched = []
+    for h in hdrlets:
+        try:
+            destim = fits.getval(h, 'DESTIM').strip()
+        except Exception:
+            invalid.append((h, traceback.format_exc()))
+            continue
+        if destim in by_root:
+            for fname in by_root[destim]:
+                hdrlets_of[fname].append(h)
+        else:
+            unmatched.append(h)
+    return [(fname, hdrlets_of[fname]) for fname in scifiles], unmatched, invalid
+
+def _apply_to_file(fname, hdrlets, primary, attach, archive, force, wcskey,
+                   wcsname):
+    """
+    Apply a list of headerlets to one science file; used by `utils.run_tasks`.
+    """
+    for h in hdrlets:
+        hlet = Headerlet.fromfile(h)
+        if primary:
+            hlet.apply_as_primary(fname, attach=attach, archive=archive,
+                                  force=force)
+        else:
+            hlet.apply_as_alternate(fname, attach=attach, wcskey=wcskey,
+                                    wcsname=wcsname)
+        hlet.close()
+
+@with_logging
+def apply_headerlets(hdrlets, filenames, primary=True, attach=True,
+                     archive=True, force=False, wcskey=None, wcsname=None,
+                     nprocs=1, logging=False, logmode='w'):
+    """
+    Apply a set of headerlets to the matching science files.
+
+    Headerlets are matched to science files by DESTIM and ROOTNAME (see
+    `match_headerlets`). Each science file is updated by one process, with
+    its headerlets applied in input order; different science files are
+    updated in parallel when nprocs is not 1.
+
+    Parameters
+    ----------
+    hdrlets: string or list of strings
+            Headerlet files: a list, a string with wild cards, an @-file or
+            a directory (all FITS files in it)
+    filenames: string or list of strings
+            Science files, in any of the forms accepted for hdrlets
+    primary: boolean
+            If True (default), apply the headerlets as primary WCS,
+            otherwise as alternate WCS
+    attach, archive, force: boolean
+            See `apply_headerlet_as_primary`; archive and force are used
+            only when primary is True
+    wcskey, wcsname: string or None
+            See `apply_headerlet_as_alternate`; used only when primary is
+            False
+    nprocs: int
+            Number of worker processes, None to use all available CPUs.
+            If 1 (default), files are updated in this process.
+    logging: boolean
+            enable file logging
+    logmode: 'w' or 'a'
+            log file open mode
+
+    Returns
+    -------
+    report: list of dictionaries
+            One dictionary per science file, in input order, followed by one
+            per unmatched headerlet and one per file which could not be
+            read (see `match_headerlets`), with keys 'filename', 'hdrlets'
+            (the headerlets applied), 'status' ('OK', 'FAILED' or
+            'NOMATCH'), 'error' (the traceback of the failure or None) and
+            'time' (processing time in seconds). Entries of headerlets have
+            filename None.
+    """
+    hdrlets = _expand_input(hdrlets)
+    filenames = _expand_input(filenames)
+    matches, unmatched, invalid = match_headerlets(hdrlets, filenames)
+    tasks = [(fname, hlist, primary, attach, archive, force, wcskey, wcsname)
+             for fname, hlist in matches if hlist]
+
+    results = utils.run_tasks(_apply_to_file, tasks, logger.name,
+                              "Failed to apply headerlets to %s",
+                              nprocs=nprocs)
+    results = dict([(t[0], r) for t, r in zip(tasks, results)])
+
+    report = []
+    for fname, hlist in matches:
+        if fname in results:
+            results[fname].update({'filename': fname, 'hdrlets': hlist})
+            report.append(results[fname])
+        else:
+            report.append({'filename': fname, 'hdrlets': [], 'status': 'NOMATCH',
+                           'error': None, 'time': 0.})
+    for h in unmatched:
+        report.append({'filename': None, 'hdrlets': [h], 'status': 'NOMATCH',
+                       'error': None, 'time': 0.})
+    for name, error in invalid:
+        # the file could not be matched: a science file or a headerlet
+        if name in hdrlets:
+            entry = {'filename': None, 'hdrlets': [name]}
+        else:
+            entry = {'filename': name, 'hdrlets': []}
+        entry.update({'status': 'FAILED', 'error': error, 'time': 0.})
+        report.append(entry)
+        logger.error("Could not read %s:\n%s" % (name, error))
+
+    failed = [r['filename'] for r in report
+              if r['status'] == 'FAILED' and r['filename'] is not None]
+    nfailed = len([r for r in results.values() if r['status'] == 'FAILED'])
+    logger.info("Applied %d headerlets to %d files, %d files failed, "
+                "%d files and %d headerlets without match, %d files not read" %
+                (sum([len(t[1]) for t in tasks]), len(tasks) - nfailed,
+                 nfailed, len(matches) - len(tasks), len(unmatched),
+                 len(invalid)))
+    if failed:
+        logger.critical("Headerlets could not be applied to: %s" % failed)
+    return report
+
 @with_logging
 def attach_headerlet(filename, hdrlet, logging=False, logmode='a'):
     """
@@ -1323,8 +1633,9 @@ def _delete_single_headerlet(filename, hdrname=None, hdrext=None, distname=None,
         selections = {'distname': distname}
     wcscorr.delete_wcscorr_row(fobj['WCSCORR'].data, selections)
 
-    # delete the headerlet extension now
-    for hdrind in hdrlet_ind:
+    # delete the headerlet extension now, starting from the last one so that
+    # the other indices remain valid
+    for hdrind in sorted(hdrlet_ind, reverse=True):
         del fobj[hdrind]
 
     utils.updateNEXTENDKw(fobj)
@@ -1386,12 +1697,13 @@ def headerlet_summary(filename, columns=None, pad=2, maxwidth=None,
     extnums_col['width'] = 6
 
     fobj, fname, close_fobj = parse_filename(filename)
-    # find all HDRLET extensions and combine info into a single summary
-    for extn in fobj:
+    # find all HDRLET extensions and combine info into a single summary,
+    # the embedded headerlets are only read for keywords missing from the
+    # extension headers
+    for hdrlet_indx, extn in enumerate(fobj):
         if 'extname' in extn.header and extn.header['extname'] == 'HDRLET':
-            hdrlet_indx = fobj.index_of(('hdrlet', extn.header['extver']))
             try:
-                ext_cols, ext_summary = extn.headerlet.summary(columns=summary_cols)
+                ext_cols, ext_summary = extn.summary(columns=summary_cols)
                 extnums_col['vals'].append(hdrlet_indx)
                 for kw in summary_cols:
                     for key in COLUMN_DICT:
@@ -1462,10 +1774,7 @@ def restore_from_headerlet(filename, hdrname=None, hdrext=None, archive=True,
     hdrlet_indx = hdrlet_ind[0]
 
     # read headerlet from HeaderletHDU into memory
-    if hasattr(fobj[hdrlet_ind[0]], 'hdulist'):
-        hdrlet = fobj[hdrlet_indx].hdulist
-    else:
-        hdrlet = fobj[hdrlet_indx].headerlet # older convention in PyFITS
+    hdrlet = fobj[hdrlet_indx].headerlet
 
     # read in the names of the extensions which HeaderletHDU updates
     extlist = []
@@ -1595,12 +1904,7 @@ def restore_all_with_distname(filename, distname, primary, archive=True,
     # Check to see whether 'primary' HeaderletHDU has same distname as user
     # specified on input
 
-    # read headerlet from HeaderletHDU into memory
-    if hasattr(fobj[primary_ind], 'hdulist'):
-        primary_hdrlet = fobj[primary_ind].hdulist
-    else:
-        primary_hdrlet = fobj[primary_ind].headerlet # older convention in PyFITS
-    pri_distname = primary_hdrlet[0].header['distname']
+    pri_distname = fobj[primary_ind].metadata('DISTNAME')
     if pri_distname != distname:
         if close_fobj:
             fobj.close()
@@ -1623,10 +1927,8 @@ def restore_all_with_distname(filename, distname, primary, archive=True,
     # read in headerletHDUs and update WCS keywords
     for hlet in hdrlet_ind:
         if fobj[hlet].header['distname'] == distname:
-            if hasattr(fobj[hlet], 'hdulist'):
-                hdrlet = fobj[hlet].hdulist
-            else:
-                hdrlet = fobj[hlet].headerlet # older convention in PyFITS
+            # read headerlet from HeaderletHDU into memory
+            hdrlet = fobj[hlet].headerlet
             if hlet == primary_ind:
                 hdrlet.apply_as_primary(fobj, attach=False,
                                         archive=archive, force=True)
@@ -1841,8 +2143,10 @@ class Headerlet(fits.HDUList):
         return hlet
 
     @classmethod
-    def fromstring(cls, data, **kwargs):
+    def fromstring(cls, data, logging=False, logmode='w', **kwargs):
         hlet = super(cls, cls).fromstring(data, **kwargs)
+        if len(hlet) > 0:
+            hlet.init_attrs()
         hlet.logging = logging
         init_logging('class Headerlet', level=logging, mode=logmode)
         return hlet
@@ -2144,7 +2448,7 @@ class Headerlet(fits.HDUList):
             tg_ext = (siphdr['TG_ENAME'], siphdr['TG_EVER'])
 
             fhdr = fobj[tg_ext].header
-            hwcs = pywcs.WCS(siphdr, self)
+            hwcs = pywcs.WCS(siphdr, tablestore.resolve_tables(self))
             hwcs_header = hwcs.to_header(key=wkey)
             _idc2hdr(siphdr, fhdr, towkey=wkey)
             if hwcs.wcs.has_cd():
@@ -2267,21 +2571,7 @@ class Headerlet(fits.HDUList):
         else:
             summary_cols = columns
 
-        # Initialize summary dict based on requested columns
-        summary = {}
-        for kw in summary_cols:
-            summary[kw] = copy.deepcopy(COLUMN_DICT)
-
-        # Populate the summary with headerlet values
-        for kw in summary_cols:
-            if kw in self[0].header:
-                val = self[0].header[kw]
-            else:
-                val = 'INDEF'
-            summary[kw]['vals'].append(val)
-            summary[kw]['width'].append(max(len(val), len(kw)))
-
-        return summary_cols, summary
+        return summary_cols, _build_summary(summary_cols, self[0].header.get)
 
     def hverify(self):
         """
@@ -2687,7 +2977,10 @@ class HeaderletHDU(fits.hdu.nonstandard.FitsHDU):
     http://listmgr.cv.nrao.edu/pipermail/fitsbits/2002-April/thread.html
 
     The Headerlet contained in the HDU's data can be accessed by the
-    `headerlet` attribute.
+    `headerlet` attribute. It is decoded the first time it is accessed.
+    Keywords describing the headerlet (HDRNAME, WCSNAME, DISTNAME, ...) are
+    copied to the header of the HDU and are read with `metadata`, which
+    does not decode the data.
     """
 
     _extension = 'HDRLET'
@@ -2700,7 +2993,68 @@ class HeaderletHDU(fits.hdu.nonstandard.FitsHDU):
         class, though the hdulist property returns a normal HDUList object.
         """
 
-        return Headerlet(self.hdulist)
+        hlet = Headerlet(self.hdulist)
+        if len(hlet) > 0:
+            hlet.init_attrs()
+        return hlet
+
+    @lazyproperty
+    def headerlet_header(self):
+        """
+        The primary header of the encapsulated headerlet.
+
+        Only the first header of the embedded file is read (and decompressed),
+        unless the headerlet has already been decoded or the HDU was created
+        in memory and has not been read from a file.
+        """
+        if 'hdulist' in self.__dict__ or self._file is None:
+            return self.hdulist[0].header
+        stream = self._payload_stream()
+        try:
+            return fits.Header.fromfile(stream, padding=False)
+        finally:
+            stream.close()
+
+    def _payload_stream(self):
+        """
+        Returns a file object reading the embedded FITS file from the
+        container file, decompressing it as it is read.
+        """
+        stream = _ByteRangeReader(self._file, self._data_offset, self.size)
+        if self._header['COMPRESS']:
+            stream = gzip.GzipFile(fileobj=stream, mode='rb')
+        return stream
+
+    def metadata(self, keyword, default=None):
+        """
+        Returns the value of a keyword of the headerlet primary header.
+
+        The value is read from the header of this HDU if it was copied there,
+        otherwise from the embedded headerlet (see `headerlet_header`).
+        If the keyword is not found, default is returned, or KeyError raised
+        if default is None.
+        """
+        if keyword in self.header:
+            return self.header[keyword]
+        hdr = self.headerlet_header
+        if keyword in hdr:
+            return hdr[keyword]
+        if default is None:
+            raise KeyError("Keyword %s not found in headerlet %s" %
+                           (keyword, self.header.get('HDRNAME', '')))
+        return default
+
+    def summary(self, columns=None):
+        """
+        Returns a summary of the encapsulated headerlet, like
+        `Headerlet.summary`, without decoding it when all requested
+        keywords are in the header of this HDU.
+        """
+        if columns is None:
+            summary_cols = DEFAULT_SUMMARY_COLS
+        else:
+            summary_cols = columns
+        return summary_cols, _build_summary(summary_cols, self.metadata)
 
     @classmethod
     def fromheaderlet(cls, headerlet, compress=False):
@@ -2746,9 +3100,51 @@ class HeaderletHDU(fits.hdu.nonstandard.FitsHDU):
                                    phdu.header.comments['NPOLFILE'])
         hlet.header['D2IMFILE'] = (phdu.header['D2IMFILE'],
                                    phdu.header.comments['D2IMFILE'])
+        for kw in ['AUTHOR', 'DESCRIP']:
+            if kw in phdu.header:
+                hlet.header[kw] = (phdu.header[kw], phdu.header.comments[kw])
         hlet.header['EXTNAME'] = (cls._extension, 'Extension name')
 
         return hlet
 
 
 fits.register_hdu(HeaderletHDU)
+
+
+class _ByteRangeReader(io.RawIOBase):
+    """
+    A read-only file object over a range of bytes of an open file, used to
+    stream the data of a HeaderletHDU without copying it.
+    """
+    def __init__(self, fileobj, offset, size):
+        self._fileobj = fileobj
+        self._offset = offset
+        self._size = size
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, pos, whence=0):
+        if whence == 1:
+            pos += self._pos
+        elif whence == 2:
+            pos += self._size
+        self._pos = max(0, min(pos, self._size))
+        return self._pos
+
+    def readinto(self, b):
+        n = min(len(b), self._size - self._pos)
+        if n <= 0:
+            return 0
+        self._fileobj.seek(self._offset + self._pos)
+        data = self._fileobj.read(n)
+        b[:len(data)] = data
+        self._pos += len(data)
+        return len(data)
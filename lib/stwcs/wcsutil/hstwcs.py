@@ -1,10 +1,16 @@
 from __future__ import absolute_import, division, print_function # confidence high
 
 import os
-from astropy.wcs import WCS
+import copy
+import threading
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+from collections import deque
+from astropy.wcs import WCS, WCSBase, Sip, Wcsprm, DistortionLookupTable
 from astropy.io import fits
-from stwcs.distortion import models, coeff_converter
+from stwcs.distortion import models, coeff_converter, mutil, tablestore
 import numpy as np
+from numpy.polynomial import polynomial
 from stsci.tools import fileutil
 
 from . import altwcs
@@ -53,6 +59,300 @@ def build_default_wcsname(idctab):
     wcsname = 'IDC_' + idcname
     return wcsname
 
+def _poly_derivative(coeffs, axis):
+    """
+    Derivative of a SIP polynomial.
+
+    Parameters
+    ----------
+    coeffs : 2D array
+        SIP coefficients, coeffs[p,q] multiplies x**p * y**q.
+    axis : int
+        0 for the derivative with respect to x, 1 with respect to y.
+
+    Returns
+    -------
+    dcoeffs, order : 2D array, int
+        Coefficients of the derivative in the IDC convention used by
+        `stwcs.distortion.mutil.evaluate_poly2d` and its order.
+    """
+    deriv = polynomial.polyder(coeffs, axis=axis)
+    order = max(coeffs.shape[0] - 2, 0)
+    dcoeffs = np.zeros((order + 1, order + 1), dtype=np.float64)
+    for p in range(deriv.shape[0]):
+        for q in range(deriv.shape[1]):
+            if p + q <= order:
+                dcoeffs[p + q, p] = deriv[p, q]
+    return dcoeffs, order
+
+def _is_coord_pair(obj):
+    return isinstance(obj, tuple) and len(obj) == 2 and \
+           all(isinstance(a, np.ndarray) and a.ndim == 1 for a in obj)
+
+def _catalog_length(coords):
+    """
+    Number of points in a catalog passed to the chunked transformations
+    of `HSTWCS`, None if it is not known before iterating over it.
+    """
+    if isinstance(coords, np.ndarray):
+        return coords.shape[0]
+    if _is_coord_pair(coords):
+        return coords[0].shape[0]
+    return None
+
+def _iter_coord_blocks(coords, chunksize):
+    """
+    Split a catalog passed to the chunked transformations of `HSTWCS`
+    into pairs of 1-D arrays of at most chunksize points.
+    """
+    if isinstance(coords, np.ndarray) or _is_coord_pair(coords):
+        chunks = [coords]
+    else:
+        chunks = coords
+    for chunk in chunks:
+        if isinstance(chunk, tuple) or isinstance(chunk, list):
+            a, b = chunk
+            a = np.asanyarray(a)
+            b = np.asanyarray(b)
+        else:
+            chunk = np.asanyarray(chunk)
+            if chunk.ndim != 2 or chunk.shape[1] != 2:
+                raise ValueError("Expected Nx2 arrays of coordinates.")
+            a = chunk[:, 0]
+            b = chunk[:, 1]
+        if a.shape != b.shape:
+            raise ValueError("Both coordinates must have the same length.")
+        for i in range(0, a.shape[0], chunksize):
+            yield a[i:i+chunksize], b[i:i+chunksize]
+
+def _world2pix_block(wcs, ra, dec, origin, kwargs):
+    try:
+        x, y = wcs.all_world2pix(ra, dec, origin, **kwargs)
+    except NoConvergence as e:
+        x, y = e.best_solution
+        return x, y, e
+    return x, y, None
+
+def _pix2world_block(wcs, x, y, origin, kwargs):
+    ra, dec = wcs.all_pix2world(x, y, origin)
+    return ra, dec, None
+
+def _map_blocks(wcs, func, coords, origin, kwargs, chunksize, nthreads):
+    """
+    Apply a transformation to consecutive blocks of a catalog.
+
+    func(wcs, a, b, origin, kwargs) returns the transformed block and an
+    exception (or None). Yields (start, a, b, exc) in catalog order, the
+    indices in exc are relative to the whole catalog.
+    """
+    chunksize = int(chunksize)
+    if chunksize < 1:
+        raise ValueError("'chunksize' must be a positive integer.")
+    if nthreads is None:
+        nthreads = multiprocessing.cpu_count()
+    blocks = _iter_coord_blocks(coords, chunksize)
+
+    if nthreads <= 1:
+        # input blocks are copied into these buffers, so that memory
+        # mapped catalogs are read one block at a time
+        abuf = np.empty(chunksize, dtype=np.float64)
+        bbuf = np.empty(chunksize, dtype=np.float64)
+        start = 0
+        for a, b in blocks:
+            n = a.shape[0]
+            if n == 0:
+                continue
+            np.copyto(abuf[:n], a)
+            np.copyto(bbuf[:n], b)
+            a, b, exc = func(wcs, abuf[:n], bbuf[:n], origin, kwargs)
+            yield start, a, b, _offset_indices(exc, start)
+            start += n
+        return
+
+    # wcslib keeps intermediate results in the wcsprm structure, so each
+    # thread transforms its blocks with its own copy of the WCS
+    local = threading.local()
+    def run(a, b):
+        w = getattr(local, 'wcs', None)
+        if w is None:
+            w = local.wcs = copy.deepcopy(wcs)
+        return func(w, a, b, origin, kwargs)
+
+    pool = ThreadPool(nthreads)
+    pending = deque()
+    start = 0
+    try:
+        for a, b in blocks:
+            n = a.shape[0]
+            if n == 0:
+                continue
+            a = np.array(a, dtype=np.float64)
+            b = np.array(b, dtype=np.float64)
+            pending.append((start, pool.apply_async(run, (a, b))))
+            start += n
+            # limit the number of blocks held in memory
+            if len(pending) >= 2 * nthreads:
+                s, result = pending.popleft()
+                a, b, exc = result.get()
+                yield s, a, b, _offset_indices(exc, s)
+        while pending:
+            s, result = pending.popleft()
+            a, b, exc = result.get()
+            yield s, a, b, _offset_indices(exc, s)
+    finally:
+        pool.terminate()
+        pool.join()
+
+def _offset_indices(exc, start):
+    if exc is not None:
+        for attr in ['divergent', 'failed2converge']:
+            ind = getattr(exc, attr)
+            if ind is not None:
+                setattr(exc, attr, ind + start)
+    return exc
+
+
+class InverseDistortionGrid(object):
+    """
+    Tabulated inverse of the distortion of a chip.
+
+    The correction ``x - pix2foc(x)`` is computed on a regular grid of
+    undistorted pixel positions covering the chip and interpolated
+    bilinearly. Adding the interpolated correction to the undistorted
+    position (the result of ``wcs_world2pix``) gives an approximation of
+    the distorted position.
+
+    Parameters
+    ----------
+    wcs : `HSTWCS`
+        WCS providing the forward distortion model (`pix2foc`).
+    step : float
+        Spacing of the grid in pixels.
+    margin : float
+        Extent of the grid in pixels beyond the undistorted image of the
+        edges of the chip.
+    accuracy : float
+        Accuracy in pixels of the inverse at the grid nodes.
+    maxiter : int
+        Maximum number of iterations used to invert the distortion at
+        the grid nodes. Nodes which do not converge are excluded.
+
+    Attributes
+    ----------
+    maxerr : float
+        Largest difference, in pixels, between the interpolated and the
+        exact inverse on a 4x4 subgrid of every grid cell, which includes
+        the cell centres where the bilinear interpolation of a smooth
+        function is least accurate. It is the error bound of the
+        approximate mode of `HSTWCS.all_world2pix` for positions on the
+        chip and within the margin. Distortions varying on scales smaller
+        than `step / 4` (e.g. a column-by-column D2IM correction) are only
+        partially sampled by this estimate.
+    """
+    def __init__(self, wcs, step=32., margin=64., accuracy=1.0e-8,
+                 maxiter=100):
+        self.step = float(step)
+        self.margin = float(margin)
+        self._models = _distortion_models(wcs)
+        # The grid covers the undistorted image of the chip and the margin,
+        # nodes are in 1-based undistorted pixel coordinates.
+        bx = np.linspace(1., wcs.naxis1, max(int(wcs.naxis1 // step), 2))
+        by = np.linspace(1., wcs.naxis2, max(int(wcs.naxis2 // step), 2))
+        bu, bv = wcs.pix2foc(np.concatenate([bx, bx, np.ones_like(by),
+                                             np.zeros_like(by) + wcs.naxis1]),
+                             np.concatenate([np.ones_like(bx),
+                                             np.zeros_like(bx) + wcs.naxis2,
+                                             by, by]), 1)
+        self.x0 = np.floor(bu.min() - margin)
+        self.y0 = np.floor(bv.min() - margin)
+        nx = int(np.ceil((bu.max() + margin - self.x0) / self.step)) + 1
+        ny = int(np.ceil((bv.max() + margin - self.y0) / self.step)) + 1
+        u, v = np.meshgrid(self.x0 + self.step * np.arange(nx),
+                           self.y0 + self.step * np.arange(ny))
+        x, y = _invert_pix2foc(wcs, u.ravel(), v.ravel(), accuracy, maxiter)
+        self.dx = (x - u.ravel()).reshape(u.shape)
+        self.dy = (y - v.ravel()).reshape(v.shape)
+
+        # error estimate on a 4x4 subgrid of every cell
+        uc, vc = [], []
+        for du in self.step * np.arange(4) / 4.:
+            for dv in self.step * np.arange(4) / 4.:
+                if du == 0 and dv == 0:
+                    continue
+                uc.append((u[:-1, :-1] + du).ravel())
+                vc.append((v[:-1, :-1] + dv).ravel())
+        uc = np.concatenate(uc)
+        vc = np.concatenate(vc)
+        xc, yc = _invert_pix2foc(wcs, uc, vc, accuracy, maxiter)
+        dxc, dyc, inside = self.interpolate(uc, vc)
+        err = np.hypot(uc + dxc - xc, vc + dyc - yc)[inside]
+        err = err[np.isfinite(err)]
+        self.maxerr = err.max() if err.size else 0.
+
+    def matches(self, wcs):
+        """
+        True if the grid was computed for the distortion model of `wcs`.
+        """
+        return all(a is b for a, b in zip(self._models,
+                                          _distortion_models(wcs)))
+
+    def interpolate(self, u, v, origin=1):
+        """
+        Interpolate the correction at undistorted pixel positions.
+
+        Returns
+        -------
+        dx, dy, inside : arrays
+            The correction to add to (u, v) and a boolean array, False for
+            positions outside the grid or in cells with an excluded node,
+            where the correction is not valid.
+        """
+        fx = (np.asarray(u, dtype=np.float64) + (1 - origin) - self.x0) / \
+             self.step
+        fy = (np.asarray(v, dtype=np.float64) + (1 - origin) - self.y0) / \
+             self.step
+        ny, nx = self.dx.shape
+        inside = (fx >= 0) & (fx <= nx - 1) & (fy >= 0) & (fy <= ny - 1)
+        i = np.clip(np.floor(fx), 0, nx - 2).astype(np.intp)
+        j = np.clip(np.floor(fy), 0, ny - 2).astype(np.intp)
+        fx -= i
+        fy -= j
+        corr = []
+        for table in (self.dx, self.dy):
+            c = (table[j, i] * (1. - fx) + table[j, i + 1] * fx) * (1. - fy) + \
+                (table[j + 1, i] * (1. - fx) + table[j + 1, i + 1] * fx) * fy
+            corr.append(c)
+        inside &= np.isfinite(corr[0]) & np.isfinite(corr[1])
+        return corr[0], corr[1], inside
+
+def _distortion_models(wcs):
+    return (wcs.sip, wcs.cpdis1, wcs.cpdis2, wcs.det2im1, wcs.det2im2)
+
+def _invert_pix2foc(wcs, u, v, accuracy, maxiter):
+    """
+    Solve pix2foc(x, y) = (u, v) (1-based) by consecutive approximations.
+    Points which do not converge are set to NaN.
+    """
+    x = u.copy()
+    y = v.copy()
+    accuracy2 = accuracy ** 2
+    old = np.seterr(invalid='ignore', over='ignore')
+    try:
+        for k in range(maxiter):
+            dx, dy = wcs.pix2foc(x, y, 1)
+            dx -= u
+            dy -= v
+            x -= dx
+            y -= dy
+            dn2 = dx ** 2 + dy ** 2
+            if np.all(~(dn2 >= accuracy2)):
+                break
+        x[~(dn2 < accuracy2)] = np.nan
+        y[~(dn2 < accuracy2)] = np.nan
+    finally:
+        np.seterr(**old)
+    return x, y
+
 
 class NoConvergence(Exception):
     """
@@ -135,30 +435,14 @@ class HSTWCS(WCS):
         if fobj is not None:
             filename, hdr0, ehdr, phdu = getinput.parseSingleInput(f=fobj,
                                                                    ext=ext)
-            self.filename = filename
-            instrument_name = hdr0.get('INSTRUME', 'DEFAULT')
-            if instrument_name == 'DEFAULT' or instrument_name not in list(inst_mappings.keys()):
-                #['IRAF/ARTDATA','',' ','N/A']:
-                self.instrument = 'DEFAULT'
-            else:
-                self.instrument = instrument_name
-            # Set the correct reference frame
-            refframe = determine_refframe(hdr0)
-            ehdr['RADESYS'] = refframe
-
-            WCS.__init__(self, ehdr, fobj=phdu, minerr=self.minerr,
-                         key=self.wcskey)
-            if self.instrument == 'DEFAULT':
-                self.pc2cd()
-            # If input was a `astropy.io.fits.HDUList` object, it's the user's
-            # responsibility to close it, otherwise, it's closed here.
-            if not isinstance(fobj, fits.HDUList):
-                phdu.close()
-            self.setInstrSpecKw(hdr0, ehdr)
-            self.readIDCCoeffs(ehdr)
-            extname = ehdr.get('EXTNAME', '')
-            extnum = ehdr.get('EXTVER', None)
-            self.extname = (extname, extnum)
+            try:
+                self._init_from_headers(filename, hdr0, ehdr, phdu,
+                                        *_primary_header_info(hdr0))
+            finally:
+                # If input was a `astropy.io.fits.HDUList` object, it's the
+                # user's responsibility to close it, otherwise, it's closed here.
+                if not isinstance(fobj, fits.HDUList):
+                    phdu.close()
         else:
             # create a default HSTWCS object
             self.instrument = 'DEFAULT'
@@ -168,6 +452,91 @@ class HSTWCS(WCS):
         self.setPscale()
         self.setOrient()
 
+    def _init_from_headers(self, filename, hdr0, ehdr, phdu, instrument,
+                           refframe):
+        """
+        Initialize from the headers of an extension; instrument and refframe
+        are derived from the primary header by `_primary_header_info`.
+        """
+        self.filename = filename
+        self.instrument = instrument
+        # Set the correct reference frame
+        ehdr['RADESYS'] = refframe
+
+        # lookup tables kept in a table store are read from the store
+        WCS.__init__(self, ehdr, fobj=tablestore.resolve_tables(phdu),
+                     minerr=self.minerr, key=self.wcskey)
+        if self.instrument == 'DEFAULT':
+            self.pc2cd()
+        self.setInstrSpecKw(hdr0, ehdr)
+        self.readIDCCoeffs(ehdr)
+        extname = ehdr.get('EXTNAME', '')
+        extnum = ehdr.get('EXTVER', None)
+        self.extname = (extname, extnum)
+
+    def from_file(cls, fobj, extname='SCI', minerr=0.0, wcskey=" "):
+        """
+        Create HSTWCS objects for all extensions of a file with a given
+        EXTNAME.
+
+        The file is opened once and the primary header is interpreted once
+        for all extensions, instead of once per extension as when calling
+        ``HSTWCS(filename, ext)`` in a loop.
+
+        Parameters
+        ----------
+        fobj : str or `astropy.io.fits.HDUList`
+            File name or HDUList. An HDUList is not closed.
+        extname : str or None
+            EXTNAME of the extensions (case insensitive). If None, the
+            primary HDU only is used.
+        minerr, wcskey :
+            See `HSTWCS`.
+
+        Returns
+        -------
+        wcslist : list of `HSTWCS`
+            One object per extension, in the order of the extensions in
+            the file.
+
+        Examples
+        --------
+        >>> from stwcs.wcsutil import HSTWCS
+        >>> sci1, sci2 = HSTWCS.from_file('j94f05bgq_flt.fits')
+        """
+        if isinstance(fobj, fits.HDUList):
+            hdulist = fobj
+            filename = hdulist[0].header.get('FILENAME', "")
+        else:
+            filename = fobj
+            hdulist = fits.open(fobj)
+        try:
+            hdr0 = hdulist[0].header
+            info = _primary_header_info(hdr0)
+            if extname is None:
+                exts = [0]
+            else:
+                exts = [i for i, hdu in enumerate(hdulist)
+                        if hdu.header.get('EXTNAME', '').upper() ==
+                        extname.upper()]
+            tables = tablestore.resolve_tables(hdulist)
+            wcslist = []
+            for i in exts:
+                w = cls.__new__(cls)
+                w.inst_kw = ins_spec_kw
+                w.minerr = minerr
+                w.wcskey = wcskey
+                w._init_from_headers(filename, hdr0, hdulist[i].header,
+                                     tables, *info)
+                w.setPscale()
+                w.setOrient()
+                wcslist.append(w)
+        finally:
+            if not isinstance(fobj, fits.HDUList):
+                hdulist.close()
+        return wcslist
+    from_file = classmethod(from_file)
+
     @property
     def naxis1(self):
         return self._naxis1
@@ -264,6 +633,83 @@ class HSTWCS(WCS):
         self.wcs.cd = self.wcs.cd/self.pscale*scale
         self.setPscale()
 
+    def clone(self):
+        """
+        Return a copy of this object which shares its distortion model.
+
+        Only the linear WCS (the `~astropy.wcs.Wcsprm` object) and the
+        instrument specific attributes are copied. The SIP, NPOL and D2IM
+        distortion objects, which cannot be modified, are shared with this
+        object, as are the coefficient arrays of the IDC model. The IDC
+        model itself and its `refpix` dictionary are copied, so attributes
+        of the model can be replaced in the copy without affecting this
+        object; code modifying the coefficient arrays in place must copy
+        them first.
+
+        This is much faster than `deepcopy` for WCS objects with lookup
+        table distortions.
+        """
+        new = self.__class__.__new__(self.__class__)
+        WCSBase.__init__(new, self.sip, (self.cpdis1, self.cpdis2),
+                         copy.deepcopy(self.wcs), (self.det2im1, self.det2im2))
+        for key, val in self.__dict__.items():
+            if key in ['idcmodel', '_inverse_grid']:
+                new.__dict__[key] = val
+            else:
+                new.__dict__[key] = copy.deepcopy(val)
+        model = getattr(self, 'idcmodel', None)
+        if model is not None:
+            new.idcmodel = copy.copy(model)
+            if model.refpix is not None:
+                new.idcmodel.refpix = model.refpix.copy()
+        return new
+
+    def __reduce__(self):
+        # astropy pickles a WCS as a FITS file (including the lookup table
+        # extensions) which loses the CD matrix; use __getstate__ instead.
+        return (_new_hstwcs, (self.__class__,), self.__getstate__())
+
+    def __getstate__(self):
+        """
+        Return a compact representation of this object for pickling.
+
+        The linear WCS is stored as a header string and the SIP
+        coefficients as arrays. If a default table store is set (see
+        `stwcs.distortion.tablestore.set_default_store`), the NPOL and D2IM
+        lookup tables are added to the store and only their keys are
+        stored, otherwise the arrays are included. Cached data, such as
+        the inverse distortion grid, is not included.
+        """
+        store = tablestore.get_default_store()
+        wcskey = self.wcs.alt
+        hdr = fits.Header.fromstring(self.wcs.to_header(relax=True))
+        if self.wcs.has_cd():
+            hdr = altwcs.pc2cd(hdr, key=wcskey)
+        sip = None
+        if self.sip is not None:
+            sip = (self.sip.a, self.sip.b, _sip_inverse(self.sip, 'ap'),
+                   _sip_inverse(self.sip, 'bp'), self.sip.crpix)
+        attrs = dict((k, v) for k, v in self.__dict__.items()
+                     if k != '_inverse_grid' and not k.endswith('_cache'))
+        return {'header': hdr.tostring(), 'wcskey': wcskey, 'sip': sip,
+                'cpdis': (_pack_table(self.cpdis1, store),
+                          _pack_table(self.cpdis2, store)),
+                'det2im': (_pack_table(self.det2im1, store),
+                           _pack_table(self.det2im2, store)),
+                'attrs': attrs}
+
+    def __setstate__(self, state):
+        wcsprm = Wcsprm(header=state['header'].encode('ascii'),
+                        key=state['wcskey'], relax=True)
+        sip = state['sip']
+        if sip is not None:
+            sip = Sip(*sip)
+        cpdis = tuple(_unpack_table(t) for t in state['cpdis'])
+        det2im = tuple(_unpack_table(t) for t in state['det2im'])
+        WCSBase.__init__(self, sip, cpdis, wcsprm, det2im)
+        self.__dict__.update(state['attrs'])
+        self.wcs.set()
+
     def readModel(self, update=False, header=None):
         """
         Reads distortion model from IDCTAB.
@@ -425,10 +871,10 @@ class HSTWCS(WCS):
             except AssertionError:
                 bp = None
 
-            if ap:
+            if ap is not None:
                 for card in self._sip2hdr('ap'):
                     h[card.keyword] = (card.value, card.comment)
-            if bp:
+            if bp is not None:
                 for card in self._sip2hdr('bp'):
                     h[card.keyword] = (card.value, card.comment)
         return h
@@ -472,7 +918,8 @@ class HSTWCS(WCS):
     def all_world2pix(self, *args, **kwargs):
         """
         all_world2pix(*arg, accuracy=1.0e-4, maxiter=20, adaptive=False, \
-detect_divergence=True, quiet=False)
+detect_divergence=True, quiet=False, solver='fixed-point', \
+use_inverse_grid=False, approximate=False)
 
         Performs full inverse transformation using iterative solution
         on full forward transformation with complete distortion model.
@@ -585,6 +1032,47 @@ detect_divergence=True, quiet=False)
             within a specified number of maximum iterations set by `maxiter`
             parameter. Instead, simply return the found solution.
 
+        solver : {'fixed-point', 'newton', 'quasi-newton'}, optional \
+(Default = 'fixed-point')
+            Numerical method used to refine the solution.
+
+            'fixed-point' uses the method of consecutive approximations
+            described in the `Notes` section.
+
+            'newton' uses Newton-Raphson iterations: the correction at each
+            step is the residual of the forward transformation multiplied by
+            the inverse of its Jacobian. The Jacobian of the SIP polynomials
+            is computed analytically and the Jacobians of the lookup tables
+            (NPOL and D2IM) by finite differences. Each iteration is more
+            expensive than a fixed-point iteration, but far fewer iterations
+            are needed where the distortion is strong (e.g. far from the
+            detector centre).
+
+            'quasi-newton' computes the Jacobian at the initial approximation
+            and once more after the first correction, and uses the second
+            one for all remaining iterations. Each iteration costs the same
+            as a fixed-point iteration and, because the Jacobian varies
+            slowly across the detector, the number of iterations is close
+            to that of 'newton'.
+
+            `accuracy`, `adaptive`, `detect_divergence` and
+            :py:class:`NoConvergence` have the same meaning for all solvers.
+
+        use_inverse_grid : bool, optional (Default = False)
+            Start the iterations from the tabulated inverse of the
+            distortion (see :py:meth:`build_inverse_grid`) instead of the
+            result of :py:meth:`wcs_world2pix`. The starting point is then
+            close to the solution and usually only one or two iterations
+            are needed. The grid is built on the first call and kept with
+            the WCS.
+
+        approximate : bool, optional (Default = False)
+            Return the interpolated inverse grid without iterating. The
+            error is bounded by ``get_inverse_grid().maxerr`` pixels for
+            positions on the chip (and within the margin of the grid), see
+            `InverseDistortionGrid` for how the bound is computed.
+            Positions outside the grid are solved exactly.
+
         Raises
         ------
         NoConvergence
@@ -739,6 +1227,11 @@ adaptive=False, detect_divergence=False, quiet=False)
         adaptive          = kwargs.pop('adaptive', False)
         detect_divergence = kwargs.pop('detect_divergence', True)
         quiet             = kwargs.pop('quiet', False)
+        solver            = kwargs.pop('solver', 'fixed-point')
+        use_inverse_grid  = kwargs.pop('use_inverse_grid', False)
+        approximate       = kwargs.pop('approximate', False)
+        if solver not in ['fixed-point', 'newton', 'quasi-newton']:
+            raise ValueError("Unknown solver '{0}'.".format(solver))
 
         #####################################################################
         ##                INITIALIZE ITERATIVE PROCESS:                    ##
@@ -759,22 +1252,41 @@ adaptive=False, detect_divergence=False, quiet=False)
             else:
                 return np.dstack([x0,y0])[0]
 
-        x  = x0.copy() # 0-order solution
-        y  = y0.copy() # 0-order solution
+        if use_inverse_grid or approximate:
+            # start from the tabulated inverse of the distortion
+            gdx, gdy, inside = self.get_inverse_grid().interpolate(x0, y0,
+                                                                   origin)
+            gdx[~inside] = 0.
+            gdy[~inside] = 0.
+            x = x0 + gdx
+            y = y0 + gdy
+            if approximate:
+                return self._approximate_world2pix(ra, dec, x, y, inside,
+                    origin, vect1D, accuracy=accuracy, maxiter=maxiter,
+                    adaptive=adaptive, detect_divergence=detect_divergence,
+                    quiet=quiet, solver=solver)
+        else:
+            x  = x0.copy() # 0-order solution
+            y  = y0.copy() # 0-order solution
+
+        # Jacobian kept for all iterations by the quasi-Newton solver:
+        jac = None
+        if solver == 'quasi-newton':
+            jac = self.pix2foc_jacobian(x, y, origin)
 
         # initial correction:
-        dx, dy = self.pix2foc(x, y, origin)
-        # If pix2foc does not apply all the required distortion
-        # corrections then replace the above line with:
-        #r0, d0 = self.all_pix2world(x, y, origin)
-        #dx, dy = self.wcs_world2pix(r0, d0, origin )
-        dx -= x0
-        dy -= y0
+        dx, dy = self._world2pix_correction(x, y, x0, y0, origin, solver,
+                                            jac)
 
         # update initial solution:
         x -= dx
         y -= dy
 
+        if solver == 'quasi-newton':
+            # the initial approximation can be far from the solution, so
+            # evaluate the Jacobian again close to it:
+            jac = self.pix2foc_jacobian(x, y, origin)
+
         # norn (L2) squared of the correction:
         dn2prev   = dx**2+dy**2
         dn2       = dn2prev
@@ -802,13 +1314,8 @@ adaptive=False, detect_divergence=False, quiet=False)
                     break
 
                 # find correction to the previous solution:
-                dx, dy = self.pix2foc(x, y, origin)
-                # If pix2foc does not apply all the required distortion
-                # corrections then replace the above line with:
-                #r0, d0 = self.all_pix2world(x, y, origin)
-                #dx, dy = self.wcs_world2pix(r0, d0, origin )
-                dx -= x0
-                dy -= y0
+                dx, dy = self._world2pix_correction(x, y, x0, y0, origin,
+                                                    solver, jac)
 
                 # update norn (L2) squared of the correction:
                 dn2 = dx**2+dy**2
@@ -851,13 +1358,13 @@ adaptive=False, detect_divergence=False, quiet=False)
                     break
 
                 # find correction to the previous solution:
-                dx[ind], dy[ind] = self.pix2foc(x[ind], y[ind], origin)
-                # If pix2foc does not apply all the required distortion
-                # corrections then replace the above line with:
-                #r0[ind], d0[ind] = self.all_pix2world(x[ind], y[ind], origin)
-                #dx[ind], dy[ind] = self.wcs_world2pix(r0[ind], d0[ind], origin)
-                dx[ind] -= x0[ind]
-                dy[ind] -= y0[ind]
+                if jac is not None:
+                    jacind = [j[ind] for j in jac]
+                else:
+                    jacind = None
+                dx[ind], dy[ind] = self._world2pix_correction(x[ind], y[ind],
+                                        x0[ind], y0[ind], origin, solver,
+                                        jacind)
 
                 # update norn (L2) squared of the correction:
                 dn2 = dx**2+dy**2
@@ -939,6 +1446,424 @@ adaptive=False, detect_divergence=False, quiet=False)
         else:
             return np.dstack( [x, y] )[0]
 
+    def _approximate_world2pix(self, ra, dec, x, y, inside, origin, vect1D,
+                               **kwargs):
+        """
+        Complete the approximate solution of :py:meth:`all_world2pix` by
+        solving exactly for the positions outside the inverse grid.
+        """
+        ind, = np.where(~inside & np.isfinite(x) & np.isfinite(y))
+        exc = None
+        if ind.shape[0] > 0:
+            try:
+                x[ind], y[ind] = self.all_world2pix(ra[ind], dec[ind], origin,
+                                                    **kwargs)
+            except NoConvergence as e:
+                x[ind], y[ind] = e.best_solution
+                for attr in ['divergent', 'failed2converge']:
+                    sub = getattr(e, attr)
+                    if sub is not None:
+                        setattr(e, attr, ind[sub])
+                exc = e
+        if vect1D:
+            sol = [x, y]
+        else:
+            sol = np.dstack([x, y])[0]
+        if exc is not None:
+            exc.best_solution = sol
+            exc.accuracy = None
+            raise exc
+        return sol
+
+    def build_inverse_grid(self, step=32., margin=64., accuracy=1.0e-8):
+        """
+        Tabulate the inverse of the distortion of this chip.
+
+        The grid is kept with the WCS and used by :py:meth:`all_world2pix`
+        when called with ``use_inverse_grid=True`` or ``approximate=True``.
+        It is recomputed when the distortion model (SIP, NPOL or D2IM) of
+        the WCS is replaced.
+
+        Parameters
+        ----------
+        step, margin, accuracy : float
+            See `InverseDistortionGrid`.
+
+        Returns
+        -------
+        grid : `InverseDistortionGrid`
+            The grid; ``grid.maxerr`` is the error bound in pixels of the
+            approximate mode of :py:meth:`all_world2pix`.
+        """
+        self._inverse_grid = InverseDistortionGrid(self, step=step,
+                                                   margin=margin,
+                                                   accuracy=accuracy)
+        return self._inverse_grid
+
+    def get_inverse_grid(self):
+        """
+        Return the inverse distortion grid, building it with the default
+        parameters of :py:meth:`build_inverse_grid` if necessary.
+        """
+        grid = getattr(self, '_inverse_grid', None)
+        if grid is None or not grid.matches(self):
+            grid = self.build_inverse_grid()
+        return grid
+
+    def fit_inverse_sip(self, order=None, step=16., margin=0.):
+        """
+        Fit the inverse SIP polynomials (AP, BP) to the full distortion.
+
+        The inverse is fitted by least squares on a regular grid of pixel
+        positions covering the chip. It inverts `pix2foc`, so the NPOL and
+        D2IM corrections are included. The SIP of the WCS is replaced by
+        one with the fitted AP and BP coefficients; they are written to
+        the header by ``wcs2header(sip2hdr=True)``.
+
+        Parameters
+        ----------
+        order : int or None
+            Order of the inverse polynomials. Defaults to the order of the
+            forward SIP polynomials plus one.
+        step : float
+            Spacing of the grid of pixel positions.
+        margin : float
+            Extent of the grid beyond the edges of the chip in pixels.
+
+        Returns
+        -------
+        residuals : dict
+            'rms' and 'max' norm of the difference, in pixels, between the
+            pixel positions and the positions given by the inverse SIP, on
+            the fitting grid ('rms', 'max') and at the centres of the grid
+            cells ('rms_check', 'max_check'), which are not used in the fit.
+        """
+        if self.sip is None:
+            raise ValueError("Inverse SIP coefficients require a forward SIP.")
+        if order is None:
+            order = max(self.sip.a_order, self.sip.b_order) + 1
+        crpix = self.sip.crpix
+
+        x1 = np.arange(1. - margin, self.naxis1 + margin + step / 2., step)
+        y1 = np.arange(1. - margin, self.naxis2 + margin + step / 2., step)
+        x, y = [a.ravel() for a in np.meshgrid(x1, y1)]
+        u, v = self.pix2foc(x, y, 1)
+        u -= crpix[0]
+        v -= crpix[1]
+        # scale the coordinates to keep the least squares well conditioned
+        scale = max(np.abs(u).max(), np.abs(v).max(), 1.)
+        powers = [(p, q) for p in range(order + 1)
+                  for q in range(order + 1 - p)]
+        design = np.column_stack([(u / scale) ** p * (v / scale) ** q
+                                  for p, q in powers])
+        sol = np.linalg.lstsq(design, np.column_stack([x - crpix[0] - u,
+                                                       y - crpix[1] - v]),
+                              rcond=None)[0]
+        ap = np.zeros((order + 1, order + 1), dtype=np.float64)
+        bp = np.zeros((order + 1, order + 1), dtype=np.float64)
+        for k, (p, q) in enumerate(powers):
+            ap[p, q] = sol[k, 0] / scale ** (p + q)
+            bp[p, q] = sol[k, 1] / scale ** (p + q)
+        self.sip = Sip(self.sip.a, self.sip.b, ap, bp, crpix)
+
+        xc, yc = [a.ravel() for a in np.meshgrid(x1[:-1] + step / 2.,
+                                                  y1[:-1] + step / 2.)]
+        residuals = {}
+        for suffix, px, py in [('', x, y), ('_check', xc, yc)]:
+            foc = np.column_stack(self.pix2foc(px, py, 1)) - crpix
+            pix = self.sip.foc2pix(foc, 1)
+            err = np.hypot(pix[:, 0] - px, pix[:, 1] - py)
+            residuals['rms' + suffix] = np.sqrt((err ** 2).mean())
+            residuals['max' + suffix] = err.max()
+        return residuals
+
+    def _world2pix_correction(self, x, y, x0, y0, origin, solver='fixed-point',
+                              jac=None):
+        """
+        Correction to subtract from the current solution (x, y) of
+        :py:meth:`all_world2pix` for the undistorted positions (x0, y0).
+
+        jac is the Jacobian (j11, j12, j21, j22) used by the Newton
+        solvers. If not given it is computed at (x, y).
+        """
+        # residual of the forward transformation:
+        dx, dy = self.pix2foc(x, y, origin)
+        # If pix2foc does not apply all the required distortion
+        # corrections then replace the above line with:
+        #r0, d0 = self.all_pix2world(x, y, origin)
+        #dx, dy = self.wcs_world2pix(r0, d0, origin )
+        dx -= x0
+        dy -= y0
+        if solver != 'fixed-point':
+            # Newton step: solve J * delta = residual
+            if jac is None:
+                jac = self.pix2foc_jacobian(x, y, origin)
+            j11, j12, j21, j22 = jac
+            det = j11 * j22 - j12 * j21
+            dx, dy = (j22 * dx - j12 * dy) / det, (j11 * dy - j21 * dx) / det
+        return dx, dy
+
+    def pix2foc_jacobian(self, x, y, origin, step=1.0):
+        """
+        Jacobian of :py:meth:`pix2foc` at the pixel positions (x, y).
+
+        The derivatives of the SIP polynomials are computed analytically.
+        The derivatives of the lookup table distortions (D2IM and NPOL),
+        which are piecewise linear, are computed by finite differences.
+
+        Parameters
+        ----------
+        x, y : arrays
+            Pixel coordinates.
+        origin : int
+            Origin of the pixel coordinates (0 or 1).
+        step : float
+            Step in pixels used for the finite differences.
+
+        Returns
+        -------
+        j11, j12, j21, j22 : arrays
+            d(focx)/dx, d(focx)/dy, d(focy)/dx, d(focy)/dy
+        """
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        # detector to image correction, applied first
+        if self.det2im1 is not None or self.det2im2 is not None:
+            xd, yd = self.det2im(x, y, origin)
+            xdx, ydx = self.det2im(x + step, y, origin)
+            xdy, ydy = self.det2im(x, y + step, origin)
+            d11 = (xdx - xd) / step
+            d21 = (ydx - yd) / step
+            d12 = (xdy - xd) / step
+            d22 = (ydy - yd) / step
+        else:
+            xd, yd = x, y
+            d11 = d22 = 1.0
+            d12 = d21 = 0.0
+
+        # lookup table (NPOL) distortion
+        if self.cpdis1 is not None or self.cpdis2 is not None:
+            xc, yc = self.p4_pix2foc(xd, yd, origin)
+            xcx, ycx = self.p4_pix2foc(xd + step, yd, origin)
+            xcy, ycy = self.p4_pix2foc(xd, yd + step, origin)
+            g11 = (xcx - xc) / step
+            g21 = (ycx - yc) / step
+            g12 = (xcy - xc) / step
+            g22 = (ycy - yc) / step
+        else:
+            g11 = np.ones_like(xd)
+            g22 = np.ones_like(xd)
+            g12 = np.zeros_like(xd)
+            g21 = np.zeros_like(xd)
+
+        # SIP polynomials
+        if self.sip is not None:
+            u = xd + (1 - origin) - self.sip.crpix[0]
+            v = yd + (1 - origin) - self.sip.crpix[1]
+            work = np.empty_like(u)
+            for coeffs, gx, gy in [(self.sip.a, g11, g12),
+                                   (self.sip.b, g21, g22)]:
+                for axis, g in [(0, gx), (1, gy)]:
+                    dcoeffs, order = _poly_derivative(coeffs, axis)
+                    g += mutil.evaluate_poly2d(dcoeffs, u, v, order,
+                                               work=work)
+
+        # chain rule
+        j11 = g11 * d11 + g12 * d21
+        j12 = g11 * d12 + g12 * d22
+        j21 = g21 * d11 + g22 * d21
+        j22 = g21 * d12 + g22 * d22
+        return j11, j12, j21, j22
+
+    def iter_all_world2pix(self, radec, origin, chunksize=100000, nthreads=1,
+                           **kwargs):
+        """
+        Generator version of :py:meth:`all_world2pix` for large catalogs.
+
+        The catalog is processed in blocks of at most `chunksize` points,
+        so the memory used by the iterative solution does not depend on
+        the size of the catalog.
+
+        Parameters
+        ----------
+        radec : array, tuple or iterable
+            Sky coordinates. One of:
+
+            - a Nx2 array, e.g. a `numpy.memmap` or a `numpy.load`-ed file
+              opened with ``mmap_mode='r'``;
+            - a tuple ``(ra, dec)`` of 1-D arrays;
+            - an iterable (e.g. a generator) of chunks, each chunk being a
+              Nx2 array or a ``(ra, dec)`` pair of 1-D arrays.
+
+        origin : int
+            Origin of the pixel coordinates (0 or 1).
+        chunksize : int
+            Maximum number of points transformed at once.
+        nthreads : int or None
+            Number of threads transforming blocks concurrently. None uses
+            one thread per CPU. Each thread works on its own copy of the
+            WCS. At most ``2 * nthreads`` blocks are held in memory.
+
+        Other keyword arguments are passed to :py:meth:`all_world2pix`.
+
+        Yields
+        ------
+        start, x, y : int, array, array
+            Index of the first point of the block in the catalog and the
+            pixel coordinates of the points in the block. Blocks are
+            yielded in catalog order.
+
+        Raises
+        ------
+        NoConvergence
+            Raised for the first block which does not converge. The indices
+            in `divergent` and `failed2converge` refer to the whole catalog.
+        """
+        for start, x, y, exc in _map_blocks(self, _world2pix_block, radec,
+                                            origin, kwargs, chunksize,
+                                            nthreads):
+            if exc is not None:
+                raise exc
+            yield start, x, y
+
+    def all_world2pix_chunked(self, radec, origin, out=None, chunksize=100000,
+                              nthreads=1, **kwargs):
+        """
+        :py:meth:`all_world2pix` with bounded memory for large catalogs.
+
+        Parameters
+        ----------
+        radec : array, tuple or iterable
+            Sky coordinates, see :py:meth:`iter_all_world2pix`.
+        origin : int
+            Origin of the pixel coordinates (0 or 1).
+        out : array or str, optional
+            Nx2 array (e.g. a `numpy.memmap`) where the pixel coordinates
+            are written, or the name of a ``.npy`` file created as a memory
+            mapped array. If not given an array is allocated, in which case
+            only the temporary arrays, not the result, are bounded by
+            `chunksize`.
+        chunksize : int
+            Maximum number of points transformed at once.
+        nthreads : int or None
+            Number of threads transforming blocks concurrently, see
+            :py:meth:`iter_all_world2pix`.
+
+        Other keyword arguments are passed to :py:meth:`all_world2pix`.
+
+        Returns
+        -------
+        out : array
+            Nx2 array of pixel coordinates.
+
+        Raises
+        ------
+        NoConvergence
+            Raised, unless ``quiet=True``, after all blocks are processed if
+            any of them did not converge. `best_solution` is `out`,
+            `divergent` and `failed2converge` are indices in the whole
+            catalog and `accuracy` is not set.
+        """
+        return self._transform_chunked(_world2pix_block, radec, origin, out,
+                                       chunksize, nthreads, kwargs,
+                                       'all_world2pix_chunked')
+
+    def all_pix2world_chunked(self, xy, origin, out=None, chunksize=100000,
+                              nthreads=1):
+        """
+        :py:meth:`all_pix2world` with bounded memory for large catalogs.
+
+        Parameters
+        ----------
+        xy : array, tuple or iterable
+            Pixel coordinates, in any of the forms accepted by
+            :py:meth:`iter_all_world2pix`.
+        origin : int
+            Origin of the pixel coordinates (0 or 1).
+        out : array or str, optional
+            Nx2 array or name of a ``.npy`` file where the sky coordinates
+            are written, see :py:meth:`all_world2pix_chunked`.
+        chunksize : int
+            Maximum number of points transformed at once.
+        nthreads : int or None
+            Number of threads transforming blocks concurrently, see
+            :py:meth:`iter_all_world2pix`.
+
+        Returns
+        -------
+        out : array
+            Nx2 array of sky coordinates.
+        """
+        return self._transform_chunked(_pix2world_block, xy, origin, out,
+                                       chunksize, nthreads, {},
+                                       'all_pix2world_chunked')
+
+    def _transform_chunked(self, func, coords, origin, out, chunksize,
+                           nthreads, kwargs, name):
+        npts = _catalog_length(coords)
+        if isinstance(out, str):
+            if npts is None:
+                raise ValueError("The number of points must be known to "
+                                 "create the output file {0}.".format(out))
+            out = np.lib.format.open_memmap(out, mode='w+', dtype=np.float64,
+                                            shape=(npts, 2))
+        elif out is not None:
+            if out.ndim != 2 or out.shape[1] != 2:
+                raise ValueError("'out' must be a Nx2 array.")
+            if npts is not None and out.shape[0] != npts:
+                raise ValueError("'out' has {0} rows, expected {1}."
+                                 .format(out.shape[0], npts))
+        elif npts is not None:
+            out = np.empty((npts, 2), dtype=np.float64)
+
+        blocks = []
+        niter = 0
+        divergent = []
+        failed2converge = []
+        nout = 0
+        for start, a, b, exc in _map_blocks(self, func, coords, origin,
+                                            kwargs, chunksize, nthreads):
+            nout = start + a.shape[0]
+            if out is None:
+                blocks.append(np.column_stack([a, b]))
+            else:
+                if nout > out.shape[0]:
+                    raise ValueError("'out' is too small for the catalog.")
+                out[start:nout, 0] = a
+                out[start:nout, 1] = b
+            if exc is not None:
+                niter = max(niter, exc.niter)
+                if exc.divergent is not None:
+                    divergent.append(exc.divergent)
+                if exc.failed2converge is not None:
+                    failed2converge.append(exc.failed2converge)
+
+        if out is None:
+            if blocks:
+                out = np.concatenate(blocks)
+            else:
+                out = np.empty((0, 2), dtype=np.float64)
+        elif nout < out.shape[0]:
+            raise ValueError("The catalog has {0} points, 'out' has {1} rows."
+                             .format(nout, out.shape[0]))
+
+        if divergent or failed2converge:
+            divergent = np.concatenate(divergent) if divergent else None
+            failed2converge = np.concatenate(failed2converge) \
+                              if failed2converge else None
+            if divergent is None:
+                msg = "'HSTWCS.{0:s}' failed to converge to the requested " \
+                      "accuracy after {1:d} iterations.".format(name, niter)
+            else:
+                msg = "'HSTWCS.{0:s}' failed to converge to the requested " \
+                      "accuracy.{1:s}After {2:d} iterations, the solution " \
+                      "is diverging at least for one input point." \
+                      .format(name, os.linesep, niter)
+            raise NoConvergence(msg, best_solution=out, accuracy=None,
+                                niter=niter, divergent=divergent,
+                                failed2converge=failed2converge)
+        return out
+
     def _updatehdr(self, ext_hdr):
         #kw2add : OCX10, OCX11, OCY10, OCY11
         # record the model in the header for use by pydrizzle
@@ -967,6 +1892,52 @@ adaptive=False, detect_divergence=False, quiet=False)
         print('ORIENTAT : %r' % self.orientat)
 
 
+def _new_hstwcs(cls):
+    """
+    Create an uninitialized object, used to unpickle HSTWCS objects.
+    """
+    return cls.__new__(cls)
+
+def _sip_inverse(sip, k):
+    try:
+        return getattr(sip, k)
+    except AssertionError:
+        return None
+
+def _pack_table(table, store):
+    """
+    Return a picklable representation of a distortion lookup table.
+    """
+    if table is None:
+        return None
+    axes = (tuple(table.crpix), tuple(table.crval), tuple(table.cdelt))
+    if store is not None:
+        return ('store', store.path, store.put(table.data)) + axes
+    return ('array', table.data) + axes
+
+def _unpack_table(packed):
+    if packed is None:
+        return None
+    kind, source = packed[0], packed[1:-3]
+    crpix, crval, cdelt = packed[-3:]
+    if kind == 'store':
+        store = tablestore.open_store(source[0])
+        return store.lookup_table(source[1], crpix, crval, cdelt)
+    return DistortionLookupTable(source[0], crpix, crval, cdelt)
+
+def _primary_header_info(hdr0):
+    """
+    Return the instrument name and reference frame used by `HSTWCS`
+    from a primary header.
+    """
+    instrument_name = hdr0.get('INSTRUME', 'DEFAULT')
+    if instrument_name == 'DEFAULT' or instrument_name not in list(inst_mappings.keys()):
+        #['IRAF/ARTDATA','',' ','N/A']:
+        instrument = 'DEFAULT'
+    else:
+        instrument = instrument_name
+    return instrument, determine_refframe(hdr0)
+
 def determine_refframe(phdr):
     """
     Determine the reference frame in standard FITS WCS terms.
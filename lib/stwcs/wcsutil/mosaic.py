@@ -62,7 +62,7 @@ def vmosaic(fnames, outwcs=None, ref_wcs=None, ext=None, extname=None, undistort
     """
     wcsobjects = readWCS(fnames, ext, extname)
     if outwcs != None:
-        outwcs = outwcs.deepcopy()
+        outwcs = utils.copy_wcs(outwcs)
     else:
         if ref_wcs != None:
             outwcs = utils.output_wcs(wcsobjects, ref_wcs=ref_wcs, undistort=undistort)
@@ -77,7 +77,7 @@ def vmosaic(fnames, outwcs=None, ref_wcs=None, ext=None, extname=None, undistort
         outcorners = outwcs.wcs_world2pix(wobj.calc_footprint(),1)
         if plot:
             plt.plot(outcorners[:,0], outcorners[:,1])
-        objwcs = outwcs.deepcopy()
+        objwcs = utils.copy_wcs(outwcs)
         objwcs.wcs.crpix = objwcs.wcs.crpix - (outcorners[0])
         updatehdr(wobj.filename, objwcs,wkey=wkey, wcsname=wname, ext=wobj.extname, clobber=clobber)
     return outwcs
@@ -152,17 +152,7 @@ def readWCS(input, exts=None, extname=None):
                 continue
     elif extname != None:
         for f in filelist:
-            fobj = fits.open(f)
-            for i in range(len(fobj)):
-                try:
-                    ename = fobj[i].header['EXTNAME']
-                except KeyError:
-                    continue
-                if ename.lower() == extname.lower():
-                    wcso.append(wcsutil.HSTWCS(f,ext=i))
-                else:
-                    continue
-            fobj.close()
+            wcso.extend(wcsutil.HSTWCS.from_file(f, extname=extname))
     if fomited != []:
         print("These files were skipped:")
         for f in fomited:
@@ -3,6 +3,7 @@ from astropy import wcs as pywcs
 from collections import OrderedDict
 from astropy.io import fits
 from .headerlet import parse_filename
+from stwcs.distortion import tablestore
 import numpy as np
 
 def is_wcs_identical(scifile, file2, sciextlist, fextlist, scikey=" ",
@@ -52,8 +53,10 @@ def is_wcs_identical(scifile, file2, sciextlist, fextlist, scikey=" ",
         diff['rootname'] = ("%s: %s", "%s: %s") % (sciname, get_rootname(scifile), file2, get_rootname(file2))
         result = False
     for i, j in zip(sciextlist, fextlist):
-        w1 = pywcs.WCS(sciobj[i].header, sciobj, key=scikey)
-        w2 = pywcs.WCS(fobj[j].header, fobj, key=file2key)
+        w1 = pywcs.WCS(sciobj[i].header, tablestore.resolve_tables(sciobj),
+                       key=scikey)
+        w2 = pywcs.WCS(fobj[j].header, tablestore.resolve_tables(fobj),
+                       key=file2key)
         diff['extension'] = [get_extname_extnum(sciobj[i]), get_extname_extnum(fobj[j])]
         if not np.allclose(w1.wcs.crval, w2.wcs.crval, rtol=10**(-7)):
             #logger.info('CRVALs do not match')